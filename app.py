@@ -1,30 +1,39 @@
+import time
+BOOT_TIME = time.monotonic()  # Taken before the other imports so the startup report covers them.
 import os
 import re
-import time
 import json
 import asyncio
 import signal
+import threading
+import sqlite3
 import shutil
 import hashlib
-import subprocess
+import importlib
+import resource
+import bisect
+import tempfile
+import itertools
+import inspect
+import logging
+import contextlib
 from io import BytesIO
 from typing import Dict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from dateutil.parser import parse
 
 from dotenv import load_dotenv
 import aiohttp
-import yt_dlp
-from PIL import Image
-from gtts import gTTS
-from telethon import TelegramClient, events, Button
+from telethon import TelegramClient, events, Button, utils
+from telethon.extensions import markdown
 from telethon.tl.functions.channels import EditBannedRequest
 from telethon.tl.functions.contacts import BlockRequest, UnblockRequest
-from telethon.tl.functions.messages import ExportChatInviteRequest
-from telethon.tl.types import ChatBannedRights, DocumentAttributeAudio, DocumentAttributeVideo, DocumentAttributeFilename
-
-from hachoir.parser import createParser
-from hachoir.metadata import extractMetadata
+from telethon.tl.functions.messages import ExportChatInviteRequest, EditMessageRequest
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.errors import RPCError, FloodWaitError, MessageNotModifiedError
+from telethon.tl.types import MessageEntityTextUrl, PeerChannel, ChatBannedRights, DocumentAttributeAudio, DocumentAttributeVideo, DocumentAttributeFilename, InputDocument, InputFile, InputFileBig
 
 load_dotenv()
 
@@ -41,6 +50,8 @@ SESSION_NAME = os.getenv("SESSION_NAME", "my_bot_session")
 AUTH_FILE = os.getenv("AUTH_FILE", "auth_users.txt")
 AFK_FILE = os.getenv("AFK_FILE", "afk_status.json")
 CHAT_SETTINGS_FILE = "chat_settings.json"
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", "bot_state.db")
+STATE_FLUSH_DELAY = float(os.getenv("STATE_FLUSH_DELAY", "0.5"))
 
 API_BASE_URL = "http://51.222.14.176:25576/download"
 CACHE_DIRECTORY = "downloads"
@@ -48,7 +59,86 @@ YOUTUBE_ID_REGEX = r"(?:https?:\/\/)?(?:www\.|m\.)?(?:youtube\.com\/(?:watch\?v=
 FACEBOOK_REGEX = r"(?:https?:\/\/)?(?:www\.|m\.|web\.)?(facebook\.com|fb\.watch)\/(?:video\.php\?v=\d+|\S+\/videos\/\d+|\S+\/reel\/\d+|watch\/\?v=\d+|reel\/\d+|\d{15,})\/?"
 TIKTOK_REGEX = r"(?:https?:\/\/)?(?:www\.|vm\.|vt\.)?tiktok\.com\/.+"
 INSTAGRAM_REGEX = r"(?:https?:\/\/)?(?:www\.)?instagram\.com\/(?:p|reel|tv)\/[\w\-]+"
+# Used to build canonical cache keys: the media ID survives share links, tracking parameters and timestamps.
+FACEBOOK_ID_REGEX = r"(?:[?&]v=|\/videos\/|\/reel\/|facebook\.com\/)(\d{6,})|fb\.watch\/([\w-]+)"
+TIKTOK_ID_REGEX = r"\/video\/(\d+)|(?:vm|vt)\.tiktok\.com\/([\w-]+)|tiktok\.com\/t\/([\w-]+)"
+INSTAGRAM_ID_REGEX = r"instagram\.com\/(?:p|reel|tv)\/([\w-]+)"
+# One pass over a message finds every Telegram deep link and every URL-like host, with or without a scheme.
+LINK_SCAN_REGEX = re.compile(r"(?P<deeplink>tg://(?:join|resolve)\S*)|(?:https?://)?(?P<host>(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63})\b(?P<path>/\S*)?", re.IGNORECASE)
+INVITE_HOSTS = frozenset({"t.me", "telegram.me", "telegram.dog"})
+LINK_WARNING_WINDOW = int(os.getenv("LINK_WARNING_WINDOW", "60"))
+ANTIDELETE_PER_CHAT = int(os.getenv("ANTIDELETE_PER_CHAT", "1000"))
+ANTIDELETE_MAX_BYTES = int(os.getenv("ANTIDELETE_MAX_BYTES", str(32 * 1024 * 1024)))
+CACHE_INDEX_FILE = os.path.join(CACHE_DIRECTORY, "cache_index.json")
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(20 * 1024 * 1024 * 1024)))
+CACHE_MAX_AGE = int(os.getenv("CACHE_MAX_AGE", str(7 * 86400)))
+MEDIA_RESOLVE_SLOTS = int(os.getenv("MEDIA_RESOLVE_SLOTS", "4"))
+MEDIA_DOWNLOAD_SLOTS = int(os.getenv("MEDIA_DOWNLOAD_SLOTS", "3"))
+MEDIA_UPLOAD_SLOTS = int(os.getenv("MEDIA_UPLOAD_SLOTS", "2"))
+MEDIA_QUEUE_LIMIT = int(os.getenv("MEDIA_QUEUE_LIMIT", "50"))
+MEDIA_USER_LIMIT = int(os.getenv("MEDIA_USER_LIMIT", "3"))
+MIN_FREE_DISK_BYTES = int(os.getenv("MIN_FREE_DISK_BYTES", str(2 * 1024 * 1024 * 1024)))
+DISK_WAIT_TIMEOUT = int(os.getenv("DISK_WAIT_TIMEOUT", "120"))
+MAX_DOWNLOAD_BPS = int(os.getenv("MAX_DOWNLOAD_BPS", "0"))
+DOWNLOAD_SEGMENTS = int(os.getenv("DOWNLOAD_SEGMENTS", "4"))
+DOWNLOAD_MIN_SEGMENT_SIZE = int(os.getenv("DOWNLOAD_MIN_SEGMENT_SIZE", str(8 * 1024 * 1024)))
+DOWNLOAD_BUFFER_SIZE = int(os.getenv("DOWNLOAD_BUFFER_SIZE", str(1024 * 1024)))
+DOWNLOAD_RETRIES = 3
+PARTIAL_DOWNLOAD_MAX_AGE = 86400
+STREAM_UPLOAD = os.getenv("STREAM_UPLOAD", "off").lower() in ("1", "true", "on", "yes")
+METADATA_PROBE_BYTES = 8 * 1024 * 1024
+THUMBNAIL_SIZE = 320
+THUMBNAIL_MAX_BYTES = 5 * 1024 * 1024
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))
+MEDIA_WORKER_QUEUE = int(os.getenv("MEDIA_WORKER_QUEUE", "16"))
+MEDIA_TASK_TIMEOUT = int(os.getenv("MEDIA_TASK_TIMEOUT", "60"))
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "4"))
+TTS_CHUNK_CHARS = 400
+SENTENCE_END_REGEX = re.compile(r"(?<=[.!?…。])\s+|\n+")
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "2"))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", str(6 * 3600)))
+PLAY_MAX_RESULTS = 5
+PARTICIPANT_CACHE_TTL = int(os.getenv("PARTICIPANT_CACHE_TTL", "3600"))
+TAGALL_RATE = float(os.getenv("TAGALL_RATE", "0.33"))
+TAGALL_BURST = int(os.getenv("TAGALL_BURST", "3"))
+MESSAGE_LENGTH_LIMIT = 4096
+STATUS_EDITS_PER_SECOND = float(os.getenv("STATUS_EDITS_PER_SECOND", "8"))
+STATUS_CHAT_EDITS_PER_SECOND = float(os.getenv("STATUS_CHAT_EDITS_PER_SECOND", "0.5"))
+STATUS_EDIT_BURST = 3
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "5000"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = "127.0.0.1"
+LOOP_LAG_INTERVAL = 0.5
+# yt-dlp, Pillow, gTTS and hachoir are imported on first use. PREWARM=on imports them in the background once connected;
+# the yt-dlp search threads are warmed after connect either way.
+PREWARM = os.getenv("PREWARM", "off").lower() in ("1", "true", "on", "yes")
+HEAVY_MODULES = ("yt_dlp", "PIL.Image", "gtts", "hachoir.parser", "hachoir.metadata")
+ENTITY_CACHE_TTL = int(os.getenv("ENTITY_CACHE_TTL", str(6 * 3600)))
+GPT_API_URL = os.getenv("GPT_API_URL", "https://api.together.xyz/v1/chat/completions")
+GPT_MODEL = os.getenv("GPT_MODEL", "mistralai/Mixtral-8x7B-Instruct-v0.1")
+GPT_MAX_TOKENS = 1500
+GPT_CONCURRENCY = int(os.getenv("GPT_CONCURRENCY", "3"))
+GPT_CACHE_SIZE = int(os.getenv("GPT_CACHE_SIZE", "256"))
+GPT_CACHE_TTL = int(os.getenv("GPT_CACHE_TTL", "3600"))
+GPT_CONTEXT_TURNS = int(os.getenv("GPT_CONTEXT_TURNS", "0"))  # Earlier exchanges each chat sends along; 0 makes every prompt standalone.
+GPT_CONTEXT_CHARS = 8000
+GPT_CONTEXT_CHATS = 500
+GPT_STREAM_INTERVAL = 1.0
+SHELL_TIMEOUT = int(os.getenv("SHELL_TIMEOUT", "60"))
+SHELL_EDIT_INTERVAL = 3
+SHELL_PREVIEW_CHARS = 3500
+SHELL_SPOOL_MEMORY = 1024 * 1024
+SHELL_MAX_OUTPUT = 50 * 1024 * 1024
 COMMAND_COOLDOWN = 2
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "16"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_KEEPALIVE_TIMEOUT = int(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = int(os.getenv("HTTP_CONNECT_TIMEOUT", "15"))
+HTTP_READ_TIMEOUT = int(os.getenv("HTTP_READ_TIMEOUT", "60"))
+HTTP_API_TIMEOUT = int(os.getenv("HTTP_API_TIMEOUT", "120"))
 
 ## ----------------------------------------------------------------------------------------------------------------
 ## --- GLOBALS & STATE MANAGEMENT ---
@@ -57,11 +147,20 @@ AUTH_USERS = set()
 AFK_STATE = {"is_afk": False, "reason": "", "since": 0}
 CHAT_SETTINGS: Dict[int, dict] = {}
 PENDING_SHELL_COMMANDS: Dict[int, str] = {}
-ACTIVE_DOWNLOADS = set()
+RUNNING_SHELL_JOBS: Dict[int, "ShellJob"] = {}
+SHELL_JOB_IDS = itertools.count(1)
+ACTIVE_DOWNLOADS: Dict[int, int] = {}
+BACKGROUND_TASKS = set()
+IN_FLIGHT_MEDIA: Dict[str, "MediaJob"] = {}
 USER_COOLDOWNS: Dict[int, float] = {}
+FILE_REFS: Dict[str, dict] = {}
 MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024
 START_TIME = time.monotonic()
+STARTUP: Dict[str, float] = {}
 STOP_EVENT = asyncio.Event()
+HTTP_SESSION: aiohttp.ClientSession | None = None
+MEDIA_POOL: ProcessPoolExecutor | None = None
+MEDIA_WORKER_SLOTS_USED = 0
 
 try:
     API_ID = int(API_ID)
@@ -75,9 +174,104 @@ except (ValueError, TypeError):
 
 if BOT_TOKEN:
     SESSION_NAME += "_bot"
+# Uploaded file references are only valid for the account that uploaded them, so they are stored per session.
+FILE_REFS_FILE = f"{SESSION_NAME}_file_refs.json"
+FILE_REF_SCOPE = f"file_ref:{SESSION_NAME}"
+ENTITY_SCOPE = f"entity:{SESSION_NAME}"
 
 client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
 
+## ----------------------------------------------------------------------------------------------------------------
+## --- PERSISTENT STATE ---
+## ----------------------------------------------------------------------------------------------------------------
+_DELETED = object()
+
+class StateStore:
+    """SQLite (WAL) key/value store grouped by scope, e.g. ("chat", chat_id) -> settings.
+
+    `put`/`delete` only record the change and return immediately. Changes are coalesced per key and written in a
+    single transaction on a dedicated thread after STATE_FLUSH_DELAY, so handlers never block on disk and a crash
+    can't leave a half-written file behind.
+    """
+    def __init__(self, path: str, flush_delay: float):
+        self.path = path; self.flush_delay = flush_delay; self.conn = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-store")
+        self.pending: Dict[tuple, object] = {}; self.flush_task = None
+
+    async def open(self):
+        await self._run(self._connect)
+
+    async def load(self, scope: str) -> list:
+        """Returns `(key, value)` pairs for one scope."""
+        def query(): return [(key, json.loads(value)) for key, value in self.conn.execute("SELECT key, value FROM state WHERE scope = ?", (scope,))]
+        return await self._run(query)
+
+    def put(self, scope: str, key, value):
+        self.pending[(scope, str(key))] = json.dumps(value); self._schedule()
+    def delete(self, scope: str, key):
+        self.pending[(scope, str(key))] = _DELETED; self._schedule()
+
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        if not batch: return
+        try: await self._run(self._write, batch)
+        except Exception as e:
+            print(f"⚠️ Could not write state to {self.path}: {e}")
+            for key, value in batch.items(): self.pending.setdefault(key, value)
+            self._schedule()
+
+    async def close(self):
+        if self.flush_task: self.flush_task.cancel(); self.flush_task = None
+        await self.flush()
+        if self.conn: await self._run(self.conn.close); self.conn = None
+        self.executor.shutdown(wait=True)
+
+    def _schedule(self):
+        if not self.flush_task: self.flush_task = spawn(self._flush_later())
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        self.flush_task = None; await self.flush()
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL"); self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn: self.conn.execute("CREATE TABLE IF NOT EXISTS state (scope TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (scope, key))")
+        if not self.conn.execute("SELECT 1 FROM state WHERE scope = 'meta' AND key = 'migrated'").fetchone(): self._migrate_files()
+    def _write(self, batch: dict):
+        with self.conn:
+            for (scope, key), value in batch.items():
+                if value is _DELETED: self.conn.execute("DELETE FROM state WHERE scope = ? AND key = ?", (scope, key))
+                else: self.conn.execute("INSERT OR REPLACE INTO state (scope, key, value) VALUES (?, ?, ?)", (scope, key, value))
+    def _migrate_files(self):
+        """One-time import of the old auth/AFK/chat-settings/file-reference files. The originals are kept as `.migrated`;
+        unreadable JSON is set aside as `.corrupt`, and a file that cannot be opened is retried on the next start."""
+        rows = []; migrated = []; complete = True
+        for path, scope in ((AUTH_FILE, "auth"), (AFK_FILE, "afk"), (CHAT_SETTINGS_FILE, "chat"), (FILE_REFS_FILE, FILE_REF_SCOPE)):
+            if not os.path.exists(path): continue
+            try:
+                with open(path, 'r') as f:
+                    if scope == "auth": data = [line.strip() for line in f if line.strip().lstrip('-').isdigit()]
+                    else: data = json.load(f)
+                if scope not in ("auth", "afk") and not isinstance(data, dict): raise ValueError(f"expected an object, got {type(data).__name__}")
+            except ValueError as e:
+                print(f"⚠️ {path} is not valid JSON and was not migrated ({e}); it is kept as {path}.corrupt.")
+                os.replace(path, f"{path}.corrupt"); continue
+            except OSError as e:
+                print(f"⚠️ Could not read {path} for migration, will retry on the next start: {e}"); complete = False; continue
+            if scope == "auth": rows.extend(("auth", user_id, "true") for user_id in data)
+            elif scope == "afk": rows.append(("afk", "state", json.dumps(data)))
+            else: rows.extend((scope, str(key), json.dumps(value)) for key, value in data.items())
+            migrated.append(path)
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO state (scope, key, value) VALUES (?, ?, ?)", rows)
+            if complete: self.conn.execute("INSERT OR REPLACE INTO state (scope, key, value) VALUES ('meta', 'migrated', ?)", (json.dumps(int(time.time())),))
+        for path in migrated: os.replace(path, f"{path}.migrated")
+        if migrated: print(f"📦 Migrated {len(rows)} records from {', '.join(migrated)} into {self.path}.")
+
+STATE_STORE = StateStore(STATE_DB_FILE, STATE_FLUSH_DELAY)
+
 ## ----------------------------------------------------------------------------------------------------------------
 ## --- HELPER FUNCTIONS ---
 ## ----------------------------------------------------------------------------------------------------------------
@@ -88,35 +282,24 @@ def is_on_cooldown(user_id: int) -> bool:
     USER_COOLDOWNS[user_id] = time.time()
     return False
 
-def load_persistent_data():
-    global AFK_STATE, AUTH_USERS, CHAT_SETTINGS
+async def load_persistent_data():
+    global AFK_STATE, CHAT_SETTINGS
+    await STATE_STORE.open()
     AUTH_USERS.clear(); AUTH_USERS.add(SUDO_USER)
-    if os.path.exists(AUTH_FILE):
-        with open(AUTH_FILE, 'r') as f:
-            for line in f:
-                try: AUTH_USERS.add(int(line.strip()))
-                except ValueError: print(f"⚠️ Invalid line in {AUTH_FILE}: {line}")
+    for key, _ in await STATE_STORE.load("auth"): AUTH_USERS.add(int(key))
     print(f"✅ Loaded {len(AUTH_USERS)} authorized users.")
-    if os.path.exists(AFK_FILE):
-        try:
-            with open(AFK_FILE, 'r') as f: AFK_STATE = json.load(f)
-        except json.JSONDecodeError: print(f"⚠️ Could not decode AFK state from {AFK_FILE}.")
+    for _, state in await STATE_STORE.load("afk"): AFK_STATE = state
     print("✅ AFK status loaded.")
-    if os.path.exists(CHAT_SETTINGS_FILE):
-        try:
-            with open(CHAT_SETTINGS_FILE, 'r') as f: 
-                CHAT_SETTINGS = {int(k): v for k, v in json.load(f).items()}
-        except json.JSONDecodeError: print(f"⚠️ Could not decode chat settings from {CHAT_SETTINGS_FILE}.")
+    CHAT_SETTINGS = {int(key): settings for key, settings in await STATE_STORE.load("chat")}
     print(f"✅ Loaded settings for {len(CHAT_SETTINGS)} chats.")
 
-def save_chat_settings():
-    with open(CHAT_SETTINGS_FILE, 'w') as f: json.dump(CHAT_SETTINGS, f, indent=2)
-def save_auth_users():
-    with open(AUTH_FILE, 'w') as f:
-        for user_id in AUTH_USERS:
-            if user_id != SUDO_USER: f.write(f"{user_id}\n")
+def save_chat_settings(chat_id: int):
+    STATE_STORE.put("chat", chat_id, CHAT_SETTINGS[chat_id])
+def save_auth_user(user_id: int):
+    if user_id in AUTH_USERS: STATE_STORE.put("auth", user_id, True)
+    else: STATE_STORE.delete("auth", user_id)
 def save_afk_state():
-    with open(AFK_FILE, 'w') as f: json.dump(AFK_STATE, f)
+    STATE_STORE.put("afk", "state", AFK_STATE)
 def get_readable_time(seconds: int) -> str:
     seconds = int(seconds)
     periods = [('day', 86400), ('hour', 3600), ('minute', 60), ('second', 1)]
@@ -127,32 +310,204 @@ def get_readable_time(seconds: int) -> str:
             unit = name if value == 1 else name + 's'
             result.append(f"{value} {unit}")
     return ", ".join(result) or "a moment"
-async def download_file(url: str, file_path: str) -> str | None:
+def get_http_session() -> aiohttp.ClientSession:
+    """Returns the process-wide HTTP session, creating it on first use so connections and DNS lookups are reused."""
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_LIMIT_PER_HOST,
+                                         ttl_dns_cache=HTTP_DNS_CACHE_TTL, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+        # No total timeout by default: multi-GB downloads are bounded by the connect and per-read timeouts instead.
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+        HTTP_SESSION = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return HTTP_SESSION
+async def close_http_session():
+    global HTTP_SESSION
+    if HTTP_SESSION and not HTTP_SESSION.closed: await HTTP_SESSION.close()
+    HTTP_SESSION = None
+async def iter_buffered(response):
+    """Yields the response body in blocks of about DOWNLOAD_BUFFER_SIZE, so each disk write moves a lot of data."""
+    buffer = bytearray()
+    async for data in response.content.iter_any():
+        buffer += data
+        if len(buffer) >= DOWNLOAD_BUFFER_SIZE: yield bytes(buffer); buffer.clear()
+    if buffer: yield bytes(buffer)
+def plan_segments(total: int) -> list:
+    """Splits `total` bytes into `[start, end, done]` ranges, at most DOWNLOAD_SEGMENTS and none below the minimum size."""
+    count = max(1, min(DOWNLOAD_SEGMENTS, total // DOWNLOAD_MIN_SEGMENT_SIZE)); size = max(1, -(-total // count))
+    return [[start, min(start + size, total) - 1, 0] for start in range(0, total, size)]
+def load_download_state(state_path: str, total: int, validator: str | None) -> list | None:
+    try:
+        with open(state_path, 'r') as f: state = json.load(f)
+    except (OSError, json.JSONDecodeError): return None
+    if state.get("total") != total or state.get("validator") != validator: return None
+    return state.get("segments")
+def save_download_state(state_path: str, total: int, validator: str | None, segments: list):
+    with open(f"{state_path}.tmp", 'w') as f: json.dump({"total": total, "validator": validator, "segments": segments}, f)
+    os.replace(f"{state_path}.tmp", state_path)
+class DownloadProgress:
+    """Shared view of a running `download_file` call, so the file can be uploaded while it is still being written."""
+    def __init__(self):
+        self.total = None; self.segments = None; self.part_path = None; self.file_path = None
+        self.finished = False; self.failed = False
+        self.ready = asyncio.Event(); self.changed = asyncio.Event()
+    def start(self, part_path: str, file_path: str, total: int | None, segments: list | None):
+        self.part_path = part_path; self.file_path = file_path; self.total = total; self.segments = segments
+        self.ready.set(); self.changed.set()
+    def notify(self):
+        self.changed.set()
+    def finish(self, ok: bool):
+        self.finished = ok; self.failed = not ok; self.ready.set(); self.changed.set()
+    def available(self) -> int:
+        """Length of the prefix of the file that is completely on disk."""
+        if self.finished: return self.total or 0
+        for start, end, done in self.segments or []:
+            if start + done <= end: return start + done
+        return self.total if self.segments else 0
+    def current_path(self) -> str:
+        return self.file_path if self.finished else self.part_path
+    async def wait_for(self, offset: int):
+        while self.available() < offset:
+            if self.failed: raise IOError("The download failed while it was being uploaded.")
+            self.changed.clear(); await self.changed.wait()
+
+class StreamingReader:
+    """Readable for `client.upload_file` that serves a download as it arrives, waiting for bytes not yet on disk."""
+    def __init__(self, progress: DownloadProgress, name: str):
+        self.progress = progress; self.name = name; self.position = 0; self.fd = None
+    async def read(self, size: int = -1) -> bytes:
+        total = self.progress.total
+        end = total if size < 0 else min(self.position + size, total)
+        await self.progress.wait_for(end)
+        if self.fd is None: self.fd = os.open(self.progress.current_path(), os.O_RDONLY)
+        data = await asyncio.get_running_loop().run_in_executor(None, os.pread, self.fd, end - self.position, self.position)
+        self.position += len(data); return data
+    def close(self):
+        if self.fd is not None: os.close(self.fd); self.fd = None
+
+async def probe_prefix_metadata(progress: DownloadProgress) -> dict:
+    """Reads duration and dimensions from the first segment of a file that is still downloading."""
+    first_segment_end = progress.segments[0][1] + 1 if progress.segments else progress.total
+    size = min(first_segment_end, progress.total, METADATA_PROBE_BYTES)
+    await progress.wait_for(size)
+    with open(progress.current_path(), 'rb') as f: prefix = await run_sync_in_executor(lambda: f.read(size))
+    return await run_media_task(get_media_metadata, prefix)
+
+async def download_file(url: str, file_path: str, progress: DownloadProgress | None = None) -> str | None:
+    """Downloads `url` into `<file_path>.part` and renames it to `file_path` once its size is verified.
+
+    When the server honours Range requests the file is fetched as parallel segments, and the progress of each one is
+    checkpointed next to the `.part` file so a dropped connection or a restart resumes instead of starting over.
+    Passing a `DownloadProgress` lets another task follow along and read the bytes as they land.
+    """
+    result = None
+    try:
+        result = await _download_to_path(url, file_path, progress)
+        return result
+    finally:
+        if progress: progress.finish(result is not None)
+async def _download_to_path(url: str, file_path: str, progress: DownloadProgress | None) -> str | None:
+    part_path = f"{file_path}.part"; state_path = f"{part_path}.json"
+    loop = asyncio.get_running_loop()
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    with open(file_path, 'wb') as f:
-                        while True:
-                            chunk = await response.content.read(4096)
-                            if not chunk: break
-                            f.write(chunk)
-                    return file_path
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        async with get_http_session().get(url, headers={"Range": "bytes=0-0"}) as response:
+            content_range = response.headers.get("Content-Range", "")
+            total = int(content_range.rsplit('/', 1)[1]) if response.status == 206 and content_range.rsplit('/', 1)[-1].isdigit() else None
+            validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+            if response.status == 200:
+                # No range support: this response already carries the whole body.
+                expected = response.content_length; written = 0
+                segment = [0, expected - 1, 0] if expected else None
+                fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+                if progress: progress.start(part_path, file_path, expected, [segment] if segment else None)
+                try:
+                    async for block in iter_buffered(response):
+                        await loop.run_in_executor(None, os.pwrite, fd, block, written)
+                        written += len(block); DOWNLOAD_RATE.add(len(block))
+                        if segment: segment[2] = written
+                        if progress: progress.notify()
+                finally: os.close(fd)
+                if expected is not None and written != expected:
+                    print(f"Download error: got {written} of {expected} bytes for {url}"); return None
+                os.replace(part_path, file_path); return file_path
+            if response.status != 206 or total is None:
+                if response.status != 206: print(f"Download error: {url} responded with status {response.status}")
+                else: print(f"Download error: {url} did not report its size")
+                return None
+        segments = load_download_state(state_path, total, validator) if os.path.exists(part_path) else None
+        if segments: print(f"↩️ Resuming {os.path.basename(file_path)} at {human_readable_size(sum(s[2] for s in segments))}.")
+        else: segments = plan_segments(total)
+        last_checkpoint = time.monotonic()
+
+        async def fetch_segment(fd: int, segment: list) -> bool:
+            nonlocal last_checkpoint
+            for attempt in range(DOWNLOAD_RETRIES):
+                start, end, _ = segment
+                if start + segment[2] > end: return True
+                try:
+                    async with get_http_session().get(url, headers={"Range": f"bytes={start + segment[2]}-{end}"}) as response:
+                        if response.status != 206: print(f"Download error: range request got status {response.status}"); return False
+                        async for block in iter_buffered(response):
+                            block = block[:end - start - segment[2] + 1]
+                            await loop.run_in_executor(None, os.pwrite, fd, block, start + segment[2])
+                            segment[2] += len(block); DOWNLOAD_RATE.add(len(block))
+                            if progress: progress.notify()
+                            if time.monotonic() - last_checkpoint > 5:
+                                last_checkpoint = time.monotonic()
+                                await loop.run_in_executor(None, save_download_state, state_path, total, validator, [list(s) for s in segments])
+                    if start + segment[2] > end: return True
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print(f"Download segment {start}-{end} failed (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(attempt + 1)
+            return False
+
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT)
+        try:
+            if os.fstat(fd).st_size != total: await loop.run_in_executor(None, os.ftruncate, fd, total)
+            if progress: progress.start(part_path, file_path, total, segments)
+            results = await asyncio.gather(*(fetch_segment(fd, segment) for segment in segments))
+        finally:
+            os.close(fd)
+            if not all(start + done > end for start, end, done in segments):
+                await loop.run_in_executor(None, save_download_state, state_path, total, validator, segments)
+        if not all(results): return None
+        # The file was preallocated to `total`, so its size proves nothing: a segment cut short would leave a zero-filled hole.
+        # Every segment must account for exactly its own length; otherwise the saved offsets let the next attempt resume.
+        missing = sum(end - start + 1 - done for start, end, done in segments)
+        if missing: print(f"Download error: {human_readable_size(missing)} of {url} never arrived"); return None
+        os.replace(part_path, file_path)
+        if os.path.exists(state_path): os.remove(state_path)
+        return file_path
     except Exception as e: print(f"Download error: {e}")
     return None
+def spawn(coro) -> asyncio.Task:
+    """Runs a fire-and-forget coroutine, keeping a reference so the task is not garbage collected mid-flight."""
+    task = asyncio.ensure_future(coro); BACKGROUND_TASKS.add(task); task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
 async def run_sync_in_executor(func):
     loop = asyncio.get_event_loop()
     return await loop.run_in_executor(None, func)
+async def prewarm_dependencies():
+    """Imports the heavy media stacks off the event loop."""
+    start = time.monotonic()
+    for name in HEAVY_MODULES: await run_sync_in_executor(lambda: importlib.import_module(name))
+    STARTUP["prewarm"] = time.monotonic() - start
+    print(f"🔥 Pre-warmed media dependencies in {STARTUP['prewarm']:.2f}s.")
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 def human_readable_size(size_bytes: int) -> str:
     for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
         if size_bytes < 1024.0: return f"{size_bytes:.2f} {unit}"
         size_bytes /= 1024.0
     return f"{size_bytes:.2f} PB"
-def get_media_metadata(file_path: str) -> dict:
+def get_media_metadata(file_path: str | bytes) -> dict:
+    """Reads duration and dimensions with hachoir. Runs in the media worker pool, so raw bytes are accepted as well as paths."""
+    from hachoir.parser import createParser
+    from hachoir.metadata import extractMetadata
     metadata = {}
+    source = BytesIO(file_path) if isinstance(file_path, bytes) else file_path
     try:
-        parser = createParser(file_path)
+        parser = createParser(source)
         if not parser: return metadata
         with parser: data = extractMetadata(parser)
         if data:
@@ -160,28 +515,1191 @@ def get_media_metadata(file_path: str) -> dict:
             if data.has('width'): metadata['width'] = data.get('width')
             if data.has('height'): metadata['height'] = data.get('height')
     except Exception as e:
-        print(f"⚠️ Could not get metadata for {file_path}: {e}")
+        print(f"⚠️ Could not get metadata for {'<memory>' if isinstance(file_path, bytes) else file_path}: {e}")
     return metadata
-def run_shell_command(cmd: str, timeout: int = 60) -> str:
+def get_media_key(source: str, url: str, variant: str) -> str:
+    """Canonical, filename-safe cache key: the same video requested via different links maps to the same key."""
+    id_regex = {"youtube": YOUTUBE_ID_REGEX, "facebook": FACEBOOK_ID_REGEX, "tiktok": TIKTOK_ID_REGEX, "instagram": INSTAGRAM_ID_REGEX}.get(source)
+    match = re.search(id_regex, url) if id_regex else None
+    media_id = next((group for group in match.groups() if group), None) if match else None
+    if not media_id:
+        # Unknown layout: drop the query string and fragment, which only carry tracking and share parameters.
+        normalized = re.sub(r"^(?:https?:\/\/)?(?:www\.|m\.)?", "", url.split('#', 1)[0].split('?', 1)[0]).rstrip('/').lower()
+        media_id = hashlib.md5(normalized.encode()).hexdigest()
+    return f"{source}_{media_id}_{variant}"
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- MEDIA CACHE ---
+## ----------------------------------------------------------------------------------------------------------------
+class MediaCache:
+    """Size and age bounded LRU cache of downloaded media in CACHE_DIRECTORY, backed by a JSON index.
+    Each index entry can carry a `meta` sidecar (duration, dimensions, title, quality) and a normalized JPEG thumbnail
+    kept under `.thumbs/`, so a cached file can be sent again without parsing it or fetching anything."""
+    def __init__(self, directory: str, index_file: str, max_bytes: int, max_age: int):
+        self.directory = directory; self.index_file = index_file; self.max_bytes = max_bytes; self.max_age = max_age
+        self.tmp_directory = os.path.join(directory, ".tmp"); self.thumb_directory = os.path.join(directory, ".thumbs")
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.pinned: Dict[str, int] = {}
+        self.total_bytes = 0; self.dirty = False; self.hits = 0; self.misses = 0
+
+    def load(self):
+        """Loads the index. Only falls back to scanning the directory when no index exists yet."""
+        os.makedirs(self.directory, exist_ok=True)
+        self._clean_partials()
+        self.entries.clear(); self.total_bytes = 0
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'r') as f: stored = json.load(f).get("entries", {})
+            except (json.JSONDecodeError, AttributeError): print(f"⚠️ Could not decode cache index {self.index_file}."); stored = {}
+            for name, entry in sorted(stored.items(), key=lambda item: item[1].get("last_access", 0)):
+                if os.path.exists(os.path.join(self.directory, name)): self._add(name, entry)
+        else:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.startswith(('.', 'thumb_')) or not os.path.isfile(path): continue
+                stat = os.stat(path)
+                self._add(name, {"size": stat.st_size, "last_access": stat.st_mtime, "created": stat.st_mtime, "source": "unknown"})
+        self._clean_thumbnails(); self.evict(); self.save()
+        print(f"✅ Media cache: {len(self.entries)} files, {human_readable_size(self.total_bytes)} / {human_readable_size(self.max_bytes)}.")
+
+    def save(self):
+        """Writes the index atomically (temp file + rename), in LRU order."""
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, 'w') as f: json.dump({"version": 1, "entries": self.entries}, f)
+        os.replace(tmp_file, self.index_file); self.dirty = False
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def lookup(self, name: str, count: bool = True) -> str | None:
+        """Returns the path of a fresh cached file and marks it as recently used, or `None` on a miss.
+        Callers with their own statistics pass `count=False` to keep the download hit rate about downloads."""
+        entry = self.entries.get(name)
+        if not entry: self.misses += count; return None
+        path = self.path(name)
+        if time.time() - entry.get("created", 0) > self.max_age or not os.path.exists(path):
+            self.remove(name); self.misses += count; return None
+        entry["last_access"] = time.time(); self.entries.move_to_end(name); self.dirty = True; self.hits += count
+        return path
+
+    def meta(self, name: str) -> dict:
+        entry = self.entries.get(name)
+        return entry.get("meta", {}) if entry else {}
+    def set_meta(self, name: str, **fields):
+        """Merges `fields` into the entry's sidecar metadata and persists the index."""
+        entry = self.entries.get(name)
+        if not entry: return
+        entry.setdefault("meta", {}).update(fields); self.save()
+    def thumbnail_path(self, name: str) -> str:
+        return os.path.join(self.thumb_directory, f"{name}.jpg")
+    def thumbnail(self, name: str) -> str | None:
+        path = self.thumbnail_path(name)
+        return path if self.meta(name).get("thumb") and os.path.exists(path) else None
+    def store_thumbnail(self, name: str, data: bytes) -> str | None:
+        """Saves an already normalized JPEG thumbnail for a cached entry and returns its path."""
+        if name not in self.entries: return None
+        os.makedirs(self.thumb_directory, exist_ok=True); path = self.thumbnail_path(name)
+        with open(f"{path}.tmp", 'wb') as f: f.write(data)
+        os.replace(f"{path}.tmp", path); self.set_meta(name, thumb=True)
+        return path
+
+    def temp_path(self, name: str) -> str:
+        """Where to download `name` before `commit`. Nothing under the temp directory is ever returned as a cache hit.
+
+        The path is stable so `download_file` can resume an interrupted download of the same media.
+        """
+        return os.path.join(self.tmp_directory, name)
+
+    def commit(self, name: str, tmp_path: str, source: str) -> str:
+        """Atomically moves a finished download into the cache and evicts as needed. Returns the final path."""
+        path = self.path(name)
+        if name in self.entries: self._discard(name)
+        os.replace(tmp_path, path)
+        now = time.time()
+        self._add(name, {"size": os.path.getsize(path), "last_access": now, "created": now, "source": source})
+        self.pin(name)
+        try: self.evict()
+        finally: self.unpin(name)
+        self.save()
+        return path
+
+    def remove(self, name: str):
+        if name not in self.entries: return
+        self._discard(name)
+        for path in (self.path(name), self.thumbnail_path(name)):
+            with contextlib.suppress(FileNotFoundError): os.remove(path)
+        self.dirty = True
+
+    def pin(self, name: str):
+        """Protects an entry from eviction while it is being uploaded."""
+        self.pinned[name] = self.pinned.get(name, 0) + 1
+    def unpin(self, name: str):
+        if self.pinned.get(name, 0) <= 1: self.pinned.pop(name, None)
+        else: self.pinned[name] -= 1
+
+    def make_room(self, min_free: int) -> bool:
+        """Evicts least recently used entries until the disk has at least `min_free` bytes available.
+        Evicts nothing and returns False when dropping every unpinned entry still would not get there."""
+        free = shutil.disk_usage(self.directory).free
+        if free >= min_free: return True
+        if free + sum(e.get("size", 0) for n, e in self.entries.items() if n not in self.pinned) < min_free: return False
+        for name in list(self.entries):
+            if shutil.disk_usage(self.directory).free >= min_free: break
+            if name not in self.pinned: self.remove(name)
+        if self.dirty: self.save()
+        return shutil.disk_usage(self.directory).free >= min_free
+
+    def evict(self):
+        """Drops expired entries, then least recently used ones until the cache fits in its byte budget."""
+        now = time.time()
+        for name in [n for n, e in self.entries.items() if now - e.get("created", 0) > self.max_age and n not in self.pinned]:
+            self.remove(name)
+        for name in list(self.entries):
+            if self.total_bytes <= self.max_bytes: break
+            if name not in self.pinned: self.remove(name)
+
+    def _clean_partials(self):
+        """Keeps recent partial downloads for resuming and deletes the stale ones."""
+        os.makedirs(self.tmp_directory, exist_ok=True)
+        for name in os.listdir(self.tmp_directory):
+            path = os.path.join(self.tmp_directory, name)
+            if time.time() - os.path.getmtime(path) > PARTIAL_DOWNLOAD_MAX_AGE: os.remove(path)
+
+    def _clean_thumbnails(self):
+        """Deletes thumbnails whose cache entry is gone."""
+        os.makedirs(self.thumb_directory, exist_ok=True)
+        for thumb in os.listdir(self.thumb_directory):
+            if thumb.endswith(".tmp") or thumb[:-len(".jpg")] not in self.entries: os.remove(os.path.join(self.thumb_directory, thumb))
+
+    def _add(self, name: str, entry: dict):
+        self.entries[name] = entry; self.entries.move_to_end(name); self.total_bytes += entry.get("size", 0)
+    def _discard(self, name: str):
+        self.total_bytes -= self.entries.pop(name).get("size", 0)
+
+MEDIA_CACHE = MediaCache(CACHE_DIRECTORY, CACHE_INDEX_FILE, CACHE_MAX_BYTES, CACHE_MAX_AGE)
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- TELEGRAM FILE REFERENCES ---
+## ----------------------------------------------------------------------------------------------------------------
+# Maps a canonical media key to the document Telegram already has, so repeat requests are sent without re-uploading.
+async def load_file_refs():
+    global FILE_REFS
+    FILE_REFS = dict(await STATE_STORE.load(FILE_REF_SCOPE))
+    print(f"✅ Loaded {len(FILE_REFS)} uploaded file references.")
+def remember_file_ref(key: str, message, caption: str, thumb_url: str | None = None):
+    """Stores the document of a sent message under `key`, keeping a previously known thumbnail URL."""
+    document = getattr(message, "document", None)
+    if not document: return
+    entry = FILE_REFS.get(key, {})
+    entry.update({"id": document.id, "access_hash": document.access_hash, "file_reference": document.file_reference.hex(),
+                  "caption": caption, "saved": int(time.time())})
+    entry.pop("attributes", None)  # Written by older versions; document attributes now live in the media cache sidecar.
+    if thumb_url: entry["thumb_url"] = thumb_url
+    FILE_REFS[key] = entry; STATE_STORE.put(FILE_REF_SCOPE, key, entry)
+async def send_by_reference(chat_id: int, key: str) -> bool:
+    """Sends a previously uploaded document. Returns False if there is none or Telegram rejects the reference."""
+    entry = FILE_REFS.get(key)
+    if not entry or "id" not in entry: return False
+    document = InputDocument(id=entry["id"], access_hash=entry["access_hash"], file_reference=bytes.fromhex(entry["file_reference"]))
+    try: message = await client.send_file(chat_id, document, caption=entry.get("caption"))
+    except RPCError as e:
+        print(f"⚠️ File reference for {key} was rejected ({e.__class__.__name__}), uploading again."); return False
+    remember_file_ref(key, message, entry.get("caption"))
+    return True
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- MEDIA SCHEDULER ---
+## ----------------------------------------------------------------------------------------------------------------
+class RateMeter:
+    """Throughput over a sliding window of one-second buckets."""
+    def __init__(self, window: int = 5):
+        self.window = window; self.buckets = deque(); self.total = 0
+    def add(self, amount: int):
+        self.total += amount; second = int(time.monotonic())
+        if self.buckets and self.buckets[-1][0] == second: self.buckets[-1][1] += amount
+        else: self.buckets.append([second, amount]); self._trim(second)
+    def rate(self) -> float:
+        self._trim(int(time.monotonic()))
+        return sum(amount for _, amount in self.buckets) / self.window
+    def _trim(self, second: int):
+        while self.buckets and self.buckets[0][0] <= second - self.window: self.buckets.popleft()
+
+class TokenBucket:
+    """Paces calls to `rate` per second with bursts of up to `burst`. A FloodWait pauses the bucket for the full wait."""
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate; self.burst = burst; self.tokens = float(burst)
+        self.updated = time.monotonic(); self.paused_until = 0.0; self.lock = asyncio.Lock()
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds); self.tokens = 0.0; self.updated = self.paused_until
+    def delay(self) -> float:
+        """Seconds until a token is available; 0 if one is available now."""
+        now = time.monotonic()
+        if now < self.paused_until: return self.paused_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate); self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    def take(self): self.tokens -= 1
+    def full(self) -> bool:
+        """True once the bucket has refilled completely with nobody waiting on it, so a fresh one would behave the same."""
+        return self.delay() <= 0 and self.tokens >= self.burst and not self.lock.locked()
+    async def acquire(self):
+        async with self.lock:
+            while (wait := self.delay()) > 0: await asyncio.sleep(wait)
+            self.take()
+
+class _Waiter:
+    __slots__ = ("future", "on_position", "position")
+    def __init__(self, on_position):
+        self.future = asyncio.get_running_loop().create_future(); self.on_position = on_position; self.position = 0
+
+class FairLimiter:
+    """Caps concurrent jobs in one pipeline stage and hands free slots to waiting users in round-robin order."""
+    def __init__(self, name: str, limit: int):
+        self.name = name; self.limit = limit; self.active = 0
+        self.waiters: OrderedDict[int, deque] = OrderedDict()
+
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.waiters.values())
+
+    def queue_order(self) -> list:
+        """Waiters in the order they will be served: one per user per round."""
+        queues = list(self.waiters.values()); order = []
+        for i in range(max(map(len, queues), default=0)):
+            order.extend(queue[i] for queue in queues if i < len(queue))
+        return order
+
+    async def acquire(self, user_id: int, on_position=None):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1; return
+        waiter = _Waiter(on_position); self.waiters.setdefault(user_id, deque()).append(waiter)
+        self._report_positions()
+        try: await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled(): self.release()
+            else: self._forget(user_id, waiter)
+            raise
+
+    def release(self):
+        self.active -= 1
+        while self.active < self.limit and self.waiters:
+            user_id, queue = next(iter(self.waiters.items()))
+            waiter = queue.popleft()
+            # The user just served moves to the back, so one user's backlog can't starve everyone else.
+            if queue: self.waiters.move_to_end(user_id)
+            else: del self.waiters[user_id]
+            if waiter.future.done(): continue
+            self.active += 1; waiter.future.set_result(True)
+        self._report_positions()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id: int, on_position=None):
+        await self.acquire(user_id, on_position)
+        try: yield
+        finally: self.release()
+
+    def _forget(self, user_id: int, waiter: _Waiter):
+        queue = self.waiters.get(user_id)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue: del self.waiters[user_id]
+        self._report_positions()
+
+    def _report_positions(self):
+        for position, waiter in enumerate(self.queue_order(), 1):
+            if waiter.position != position and waiter.on_position:
+                waiter.position = position; spawn(waiter.on_position(position))
+
+MEDIA_STAGES = {"resolve": FairLimiter("resolve", MEDIA_RESOLVE_SLOTS), "download": FairLimiter("download", MEDIA_DOWNLOAD_SLOTS),
+                "upload": FairLimiter("upload", MEDIA_UPLOAD_SLOTS)}
+DOWNLOAD_RATE = RateMeter()
+UPLOAD_RATE = RateMeter()
+
+class InsufficientDiskError(Exception):
+    """Raised when a download cannot get MIN_FREE_DISK_BYTES of headroom, even after evicting the cache."""
+
+async def wait_for_download_capacity(on_wait):
+    """Holds a download back while the download bandwidth budget is used up, or while the disk is nearly full and only
+    entries pinned by running uploads stand in the way. Raises InsufficientDiskError once that is hopeless."""
+    notified = False; deadline = time.monotonic() + DISK_WAIT_TIMEOUT
+    while True:
+        low_disk = not MEDIA_CACHE.make_room(MIN_FREE_DISK_BYTES)
+        # Only pinned entries can still free space later; if even they would not be enough, fail right away.
+        if low_disk and (shutil.disk_usage(CACHE_DIRECTORY).free + MEDIA_CACHE.total_bytes < MIN_FREE_DISK_BYTES or time.monotonic() > deadline):
+            raise InsufficientDiskError(f"Not enough disk space: {human_readable_size(shutil.disk_usage(CACHE_DIRECTORY).free)} free, "
+                                        f"{human_readable_size(MIN_FREE_DISK_BYTES)} must stay free.")
+        saturated = MAX_DOWNLOAD_BPS and DOWNLOAD_RATE.rate() >= MAX_DOWNLOAD_BPS
+        if not low_disk and not saturated: return
+        if not notified: await on_wait("⏸️ Waiting for disk space..." if low_disk else "⏸️ Waiting for bandwidth..."); notified = True
+        await asyncio.sleep(2)
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- MEDIA SEARCH ---
+## ----------------------------------------------------------------------------------------------------------------
+class SearchBackend:
+    """YouTube search on a small pool of long-lived, pre-warmed yt-dlp instances, fronted by a TTL+LRU query cache.
+    Every lookup fetches the top `max_results` in one request, so single-result and list requests share cache entries."""
+    def __init__(self, workers: int, cache_size: int, ttl: int, max_results: int):
+        self.cache_size = cache_size; self.ttl = ttl; self.max_results = max_results
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ytsearch"); self.workers = workers
+        self.local = threading.local()
+        self.cache: OrderedDict[str, tuple] = OrderedDict()
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.hits = 0; self.misses = 0
+
+    @staticmethod
+    def normalize(query: str) -> str: return " ".join(query.lower().split())
+
+    def _ydl(self) -> "yt_dlp.YoutubeDL":
+        # YoutubeDL instances are not thread-safe, so each search thread keeps its own for the life of the process.
+        ydl = getattr(self.local, "ydl", None)
+        if ydl is None:
+            import yt_dlp
+            ydl = self.local.ydl = yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'skip_download': True, 'extract_flat': 'in_playlist'})
+            ydl.get_info_extractor("YoutubeSearch")
+        return ydl
+    def _search(self, query: str) -> list:
+        info = self._ydl().extract_info(f"ytsearch{self.max_results}:{query}", download=False)
+        results = []
+        for entry in info.get("entries") or []:
+            if not entry or not entry.get("id"): continue
+            results.append({"id": entry["id"], "title": entry.get("title") or "Unknown Title", "duration": entry.get("duration"),
+                            "url": entry.get("webpage_url") or f"https://www.youtube.com/watch?v={entry['id']}"})
+        return results
+
+    def warm(self):
+        """Builds every thread's extractor in the background so the first /play does not pay for it."""
+        barrier = threading.Barrier(self.workers)
+        def prepare():
+            with contextlib.suppress(threading.BrokenBarrierError): barrier.wait(timeout=30)  # Make each worker thread take one call.
+            self._ydl()
+        for _ in range(self.workers): self.executor.submit(prepare)
+
+    def cached(self, query: str) -> list | None:
+        key = self.normalize(query); entry = self.cache.get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None: del self.cache[key]
+            return None
+        self.cache.move_to_end(key); self.hits += 1
+        return entry[1]
+    async def search(self, query: str, limit: int = 1) -> list:
+        """Top `limit` results for `query`; concurrent lookups of the same query share one request."""
+        results = self.cached(query)
+        if results is not None: return results[:limit]
+        key = self.normalize(query)
+        if key in self.pending: return (await asyncio.shield(self.pending[key]))[:limit]
+        self.misses += 1
+        future = self.pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self._search, query)
+            if results:
+                self.cache[key] = (time.time() + self.ttl, results); self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size: self.cache.popitem(last=False)
+            future.set_result(results)
+        except asyncio.CancelledError: future.cancel(); raise
+        except Exception as e: future.set_exception(e); future.exception(); raise
+        finally: del self.pending[key]
+        return results[:limit]
+    def close(self): self.executor.shutdown(wait=False, cancel_futures=True)
+
+SEARCH_BACKEND = SearchBackend(SEARCH_WORKERS, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, PLAY_MAX_RESULTS)
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- MEDIA WORKERS ---
+## ----------------------------------------------------------------------------------------------------------------
+class MediaWorkerError(Exception):
+    """Raised when the media worker queue is full or a task overruns its timeout."""
+
+def make_sticker(image: bytes) -> bytes:
+    from PIL import Image
+    with Image.open(BytesIO(image)) as im:
+        im.thumbnail((512, 512)); out = BytesIO(); im.save(out, "WEBP")
+    return out.getvalue()
+def sticker_to_image(sticker: bytes) -> bytes:
+    from PIL import Image
+    with Image.open(BytesIO(sticker)) as im:
+        out = BytesIO(); im.convert("RGB").save(out, "JPEG")
+    return out.getvalue()
+def make_thumbnail(image: bytes) -> bytes:
+    """Scales an image to fit THUMBNAIL_SIZE and re-encodes it as the baseline JPEG Telegram expects for thumbnails."""
+    from PIL import Image
+    with Image.open(BytesIO(image)) as im:
+        im = im.convert("RGB"); im.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE)); out = BytesIO(); im.save(out, "JPEG", quality=85)
+    return out.getvalue()
+def synthesize_speech(text: str) -> bytes:
+    from gtts import gTTS
+    out = BytesIO(); gTTS(text, timeout=MEDIA_TASK_TIMEOUT).write_to_fp(out)
+    return out.getvalue()
+def named_buffer(data: bytes, name: str) -> BytesIO:
+    """Wraps in-memory file contents so Telethon can infer the mime type from `name`."""
+    buffer = BytesIO(data); buffer.name = name
+    return buffer
+
+def get_media_pool() -> ProcessPoolExecutor:
+    global MEDIA_POOL
+    if MEDIA_POOL is None: MEDIA_POOL = ProcessPoolExecutor(max_workers=MEDIA_WORKERS)
+    return MEDIA_POOL
+def shutdown_media_pool():
+    global MEDIA_POOL
+    if MEDIA_POOL is not None: MEDIA_POOL.shutdown(wait=False, cancel_futures=True); MEDIA_POOL = None
+async def run_media_task(func, *args, timeout: float = MEDIA_TASK_TIMEOUT):
+    """Runs the picklable, module-level `func(*args)` in the media process pool.
+    A queue slot is held until the worker really finishes, so tasks that overran their timeout still count against MEDIA_WORKER_QUEUE."""
+    global MEDIA_POOL, MEDIA_WORKER_SLOTS_USED
+    if MEDIA_WORKER_SLOTS_USED >= MEDIA_WORKER_QUEUE: raise MediaWorkerError("Media workers are busy, try again in a moment.")
+    MEDIA_WORKER_SLOTS_USED += 1
+    loop = asyncio.get_running_loop()
+    def free_slot():
+        global MEDIA_WORKER_SLOTS_USED
+        MEDIA_WORKER_SLOTS_USED -= 1
+    def release(_):
+        with contextlib.suppress(RuntimeError): loop.call_soon_threadsafe(free_slot)
     try:
-        process = subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True, timeout=timeout)
-        return process.stdout.strip()
-    except subprocess.CalledProcessError as e: return f"Error (code {e.returncode}):\n{e.stderr.strip()}"
-    except subprocess.TimeoutExpired: return f"Command timed out after {timeout} seconds."
-    except Exception as e: return f"Execution error: {str(e)}"
+        pool = get_media_pool()
+        try: future = pool.submit(func, *args)
+        except BrokenProcessPool:
+            # An earlier worker died (e.g. OOM killed); start a fresh pool for this and later tasks.
+            MEDIA_POOL = None; pool = get_media_pool(); future = pool.submit(func, *args)
+    except BaseException: free_slot(); raise
+    future.add_done_callback(release)
+    try: return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except asyncio.TimeoutError: raise MediaWorkerError(f"{func.__name__} timed out after {timeout}s.") from None
+    except BrokenProcessPool:
+        if MEDIA_POOL is pool: MEDIA_POOL = None
+        raise MediaWorkerError(f"Media worker crashed while running {func.__name__}.") from None
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- TEXT TO SPEECH ---
+## ----------------------------------------------------------------------------------------------------------------
+def split_sentences(text: str, limit: int) -> list:
+    """Packs whole sentences into chunks of up to `limit` characters; a longer sentence becomes a chunk of its own."""
+    chunks, current = [], ""
+    for sentence in filter(None, (part.strip() for part in SENTENCE_END_REGEX.split(text))):
+        if current and len(current) + 1 + len(sentence) > limit: chunks.append(current); current = sentence
+        else: current = f"{current} {sentence}" if current else sentence
+    if current: chunks.append(current)
+    return chunks
+
+class SpeechSynthesizer:
+    """Voice notes for text, cached in MEDIA_CACHE (and as Telegram file references) under a hash of the normalized text.
+    Long texts are synthesized sentence-chunk by sentence-chunk in parallel threads (gTTS is network-bound) and the MP3
+    parts are joined into one note. Concurrent requests for the same text share one synthesis."""
+    def __init__(self, workers: int, chunk_chars: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts"); self.chunk_chars = chunk_chars
+        self.pending: Dict[str, asyncio.Future] = {}; self.hits = 0; self.misses = 0
+
+    @staticmethod
+    def digest(text: str) -> str: return hashlib.sha256(" ".join(text.split()).encode()).hexdigest()[:32]
+    @staticmethod
+    def file_name(digest: str) -> str: return f"tts_{digest}.mp3"
+
+    async def _synthesize(self, text: str) -> bytes:
+        loop = asyncio.get_running_loop()
+        parts = [loop.run_in_executor(self.executor, synthesize_speech, chunk) for chunk in split_sentences(text, self.chunk_chars)]
+        if not parts: raise MediaWorkerError("There is no text to read out.")
+        try: return b"".join(await asyncio.wait_for(asyncio.gather(*parts), MEDIA_TASK_TIMEOUT))
+        except asyncio.TimeoutError: raise MediaWorkerError(f"Speech synthesis timed out after {MEDIA_TASK_TIMEOUT}s.") from None
+    async def voice_file(self, text: str, digest: str) -> str:
+        """Synthesizes `text` into the cache and returns the path; concurrent calls for one digest share the work."""
+        name = self.file_name(digest)
+        if digest in self.pending: return await asyncio.shield(self.pending[digest])
+        future = self.pending[digest] = asyncio.get_running_loop().create_future()
+        try:
+            audio = await self._synthesize(text); tmp_path = MEDIA_CACHE.temp_path(name)
+            with open(tmp_path, 'wb') as f: f.write(audio)
+            path = MEDIA_CACHE.commit(name, tmp_path, "tts"); future.set_result(path)
+        except asyncio.CancelledError: future.cancel(); raise
+        except Exception as e: future.set_exception(e); future.exception(); raise
+        finally: del self.pending[digest]
+        return path
+    async def send(self, chat_id: int, text: str) -> str:
+        """Sends `text` as a voice note: by file reference if Telegram has it, else from the cache, else freshly made.
+        Returns which of "file_ref", "cache" or "synthesized" it was."""
+        digest = self.digest(text); key = f"tts:{digest}"
+        if await send_by_reference(chat_id, key): return "file_ref"
+        name = self.file_name(digest); path = MEDIA_CACHE.lookup(name, count=False); cached = path is not None
+        if cached: self.hits += 1
+        else: self.misses += 1; path = await self.voice_file(text, digest)
+        MEDIA_CACHE.pin(name)
+        try: message = await client.send_file(chat_id, path, voice_note=True)
+        finally: MEDIA_CACHE.unpin(name)
+        remember_file_ref(key, message, None)
+        return "cache" if cached else "synthesized"
+    def close(self): self.executor.shutdown(wait=False, cancel_futures=True)
+
+SPEECH = SpeechSynthesizer(TTS_WORKERS, TTS_CHUNK_CHARS)
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- PARALLEL UPLOAD ---
+## ----------------------------------------------------------------------------------------------------------------
+async def upload_file_parallel(file, file_size: int | None = None, file_name: str | None = None, progress_callback=None,
+                               workers: int = UPLOAD_WORKERS):
+    """Uploads `file` (a path, or anything with a sync or async `read`) with `workers` parts in flight at once.
+
+    A single reader feeds parts in order into a bounded queue, so memory stays at a few parts per worker and the MD5
+    Telegram wants for small files is computed in order. Returns an InputFile/InputFileBig for `client.send_file`.
+    """
+    opened = None
+    if isinstance(file, str):
+        opened = file = open(file, 'rb'); file_size = file_size or os.fstat(file.fileno()).st_size
+        file_name = file_name or os.path.basename(file.name)
+    try:
+        part_size = utils.get_appropriated_part_size(file_size) * 1024
+        part_count = max(1, -(-file_size // part_size)); is_big = file_size > 10 * 1024 * 1024
+        file_id = int.from_bytes(os.urandom(8), 'big', signed=True); hash_md5 = hashlib.md5()
+        queue = asyncio.Queue(maxsize=max(1, workers) * 2); uploaded = 0
+
+        async def read_parts():
+            for index in range(part_count):
+                if opened: part = await run_sync_in_executor(lambda: file.read(part_size))
+                else:
+                    part = file.read(part_size)
+                    if inspect.isawaitable(part): part = await part
+                if len(part) != part_size and index < part_count - 1: raise ValueError(f"Read {len(part)} bytes for part {index}, expected {part_size}.")
+                if not is_big: hash_md5.update(part)
+                await queue.put((index, part))
+            for _ in range(workers): await queue.put(None)
+
+        async def send_parts():
+            nonlocal uploaded
+            while (item := await queue.get()) is not None:
+                index, part = item
+                request = SaveBigFilePartRequest(file_id, index, part_count, part) if is_big else SaveFilePartRequest(file_id, index, part)
+                if not await client(request): raise RuntimeError(f"Failed to upload file part {index}.")
+                uploaded += len(part); UPLOAD_RATE.add(len(part))
+                if progress_callback: await progress_callback(uploaded, file_size)
+
+        tasks = [asyncio.ensure_future(read_parts())] + [asyncio.ensure_future(send_parts()) for _ in range(max(1, workers))]
+        try: await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks: task.cancel()
+            raise
+        if is_big: return InputFileBig(file_id, part_count, file_name)
+        return InputFile(file_id, part_count, file_name, hash_md5.hexdigest())
+    finally:
+        if opened: opened.close()
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- STATUS UPDATES ---
+## ----------------------------------------------------------------------------------------------------------------
+class StatusEditor:
+    """Single path for status-message edits. Only the latest pending text per message is kept; edits are paced by a global
+    and a per-chat token bucket, skipped when the text is already shown, and a FloodWait pauses the affected buckets."""
+    SHOWN_LIMIT = 2048; PRUNE_INTERVAL = 60.0
+    def __init__(self, global_rate: float, chat_rate: float, burst: int):
+        self.chat_rate = chat_rate; self.burst = burst
+        self.global_bucket = TokenBucket(global_rate, burst); self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.pending: OrderedDict[tuple, list] = OrderedDict()  # key -> [message, text, link_preview, waiters]
+        self.in_flight = set(); self.shown: OrderedDict[tuple, str] = OrderedDict()
+        self.wakeup = asyncio.Event(); self.worker = None; self.pruned_at = time.monotonic()
+        self.edits = 0; self.skipped = 0; self.flood_waits = 0
+
+    async def edit(self, message, text: str, wait: bool = True, link_preview: bool = True):
+        """Queues `text` for `message`. With `wait`, returns once this text (or a newer one) is shown or has failed."""
+        key = (message.chat_id, message.id)
+        if key not in self.in_flight and key not in self.pending and self.shown.get(key) == text: self.skipped += 1; return
+        entry = self.pending.get(key)
+        if entry: entry[0] = message; entry[1] = text; entry[2] = link_preview
+        else: entry = self.pending[key] = [message, text, link_preview, []]
+        if wait: future = asyncio.get_running_loop().create_future(); entry[3].append(future)
+        self.wakeup.set()
+        if not self.worker or self.worker.done(): self.worker = spawn(self._run())
+        if wait: await future
+    def discard(self, message):
+        """Drops pending edits for a message that is about to be deleted."""
+        key = (message.chat_id, message.id); entry = self.pending.pop(key, None); self.shown.pop(key, None)
+        if entry: self._resolve(entry)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None: bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.burst)
+        return bucket
+    def _prune_buckets(self):
+        """Drops chat buckets that have refilled to full, so chats that went quiet do not keep one forever."""
+        for chat_id in [c for c, bucket in self.chat_buckets.items() if bucket.full()]: del self.chat_buckets[chat_id]
+        self.pruned_at = time.monotonic()
+    async def _run(self):
+        while self.pending:
+            if time.monotonic() - self.pruned_at > self.PRUNE_INTERVAL: self._prune_buckets()
+            self.wakeup.clear(); ready = None; wait = 60.0
+            for key in self.pending:
+                if key in self.in_flight: continue
+                delay = max(self._chat_bucket(key[0]).delay(), self.global_bucket.delay())
+                if delay <= 0: ready = key; break
+                wait = min(wait, delay)
+            if ready is None:
+                with contextlib.suppress(asyncio.TimeoutError): await asyncio.wait_for(self.wakeup.wait(), wait)
+                continue
+            entry = self.pending.pop(ready)
+            if self.shown.get(ready) == entry[1]: self.skipped += 1; self._resolve(entry); continue
+            self.global_bucket.take(); self._chat_bucket(ready[0]).take(); self.in_flight.add(ready)
+            spawn(self._send(ready, entry))
+        self._prune_buckets()
+    async def _send(self, key: tuple, entry: list):
+        message, text, link_preview, _ = entry
+        try:
+            parsed, entities = markdown.parse(text)
+            request = EditMessageRequest(peer=await message.get_input_chat(), id=message.id, message=parsed, entities=entities, no_webpage=not link_preview)
+            await client(request, flood_sleep_threshold=0); self.edits += 1; self._shown(key, text)
+        except MessageNotModifiedError: self._shown(key, text)
+        except FloodWaitError as e:
+            # Back off instead of sleeping inside the request; a newer text queued meanwhile supersedes this one.
+            self.flood_waits += 1; METRICS.inc("flood_waits_total", source="status_edit"); self._chat_bucket(key[0]).pause(e.seconds); self.global_bucket.pause(min(e.seconds, 5))
+            if key not in self.pending: self.pending[key] = entry; entry = None
+        except Exception as e: print(f"⚠️ Status edit failed: {e}")
+        finally:
+            self.in_flight.discard(key)
+            if entry: self._resolve(entry)
+            self.wakeup.set()
+            if self.pending and (not self.worker or self.worker.done()): self.worker = spawn(self._run())
+    def _shown(self, key: tuple, text: str):
+        self.shown[key] = text; self.shown.move_to_end(key)
+        while len(self.shown) > self.SHOWN_LIMIT: self.shown.popitem(last=False)
+    @staticmethod
+    def _resolve(entry: list):
+        for future in entry[3]:
+            if not future.done(): future.set_result(None)
+        entry[3].clear()
+
+STATUS_EDITOR = StatusEditor(STATUS_EDITS_PER_SECOND, STATUS_CHAT_EDITS_PER_SECOND, STATUS_EDIT_BURST)
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- PARTICIPANT CACHE ---
+## ----------------------------------------------------------------------------------------------------------------
+class ParticipantCache:
+    """Per-chat member lists (bots and deleted accounts excluded), kept current from join/leave events and fully re-fetched every `ttl` seconds."""
+    def __init__(self, ttl: int):
+        self.ttl = ttl; self.chats: Dict[int, dict] = {}; self.locks: Dict[int, asyncio.Lock] = {}
+    @staticmethod
+    def _keep(user) -> bool: return not (getattr(user, "bot", False) or getattr(user, "deleted", False))
+    async def get(self, chat_id: int, input_chat=None) -> Dict[int, str]:
+        """Maps user id to display name for every member of `chat_id`."""
+        entry = self.chats.get(chat_id)
+        if entry and time.monotonic() - entry["fetched"] < self.ttl: return entry["members"]
+        lock = self.locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            entry = self.chats.get(chat_id)
+            if entry and time.monotonic() - entry["fetched"] < self.ttl: return entry["members"]
+            members = {}
+            async for user in client.iter_participants(input_chat or chat_id):
+                if self._keep(user): members[user.id] = user.first_name or "User"
+            self.chats[chat_id] = {"members": members, "fetched": time.monotonic()}
+            return members
+    def add(self, chat_id: int, users):
+        entry = self.chats.get(chat_id)
+        if entry: entry["members"].update((user.id, user.first_name or "User") for user in users if self._keep(user))
+    def remove(self, chat_id: int, user_ids):
+        entry = self.chats.get(chat_id)
+        if entry:
+            for user_id in user_ids: entry["members"].pop(user_id, None)
+
+PARTICIPANTS = ParticipantCache(PARTICIPANT_CACHE_TTL)
+SEND_BUCKETS: Dict[int, TokenBucket] = {}; SEND_BUCKETS_PRUNED_AT = 0.0
+
+@client.on(events.ChatAction)
+async def track_participants(event):
+    if event.chat_id not in PARTICIPANTS.chats: return
+    try:
+        if event.user_joined or event.user_added: PARTICIPANTS.add(event.chat_id, await event.get_users())
+        elif event.user_left or event.user_kicked: PARTICIPANTS.remove(event.chat_id, event.user_ids)
+    except Exception as e: print(f"⚠️ Could not update participants of {event.chat_id}: {e}")
+
+def utf16_length(text: str) -> int:
+    """Length as Telegram counts it, in UTF-16 code units: emoji and other astral-plane characters count twice."""
+    return len(text.encode("utf-16-le")) // 2
+def utf16_slice(text: str, limit: int, tail: bool = False) -> str:
+    """The longest head (or tail) of `text` that fits in `limit` UTF-16 code units, without splitting a surrogate pair."""
+    if limit <= 0: return ""
+    data = text.encode("utf-16-le"); data = data[-2 * limit:] if tail else data[:2 * limit]
+    return data.decode("utf-16-le", errors="ignore")
+def pack_lines(lines, header: str, limit: int = MESSAGE_LENGTH_LIMIT):
+    """Groups markdown `lines` into as few messages as fit `limit` visible UTF-16 code units each, every message starting
+    with `header`. A line longer than one message is split across several."""
+    def visible_length(text: str) -> int: return utf16_length(re.sub(r"\[([^\]]*)\]\([^)]*\)", r"\1", text))
+    chunk, size, budget = [], 0, limit - visible_length(header) - 2
+    def pieces(line: str):
+        while visible_length(line) > budget: head = utf16_slice(line, budget); yield head; line = line[len(head):]
+        yield line
+    for line in lines:
+        for piece in pieces(line):
+            length = visible_length(piece) + 1
+            if chunk and size + length > budget: yield f"{header}\n\n" + "\n".join(chunk); chunk, size = [], 0
+            chunk.append(piece); size += length
+    if chunk: yield f"{header}\n\n" + "\n".join(chunk)
+def send_bucket(chat_id: int) -> TokenBucket:
+    """The chat's send bucket. Once a minute, buckets that have refilled to full are dropped, so quiet chats do not keep one."""
+    global SEND_BUCKETS_PRUNED_AT
+    if time.monotonic() - SEND_BUCKETS_PRUNED_AT > 60:
+        for key in [key for key, bucket in SEND_BUCKETS.items() if bucket.full()]: del SEND_BUCKETS[key]
+        SEND_BUCKETS_PRUNED_AT = time.monotonic()
+    bucket = SEND_BUCKETS.get(chat_id)
+    if bucket is None: bucket = SEND_BUCKETS[chat_id] = TokenBucket(TAGALL_RATE, TAGALL_BURST)
+    return bucket
+async def send_paced(chat_id: int, text: str, file=None, max_flood_wait: int = 600):
+    """Sends through the chat's token bucket, waiting out FloodWaits that Telethon does not sleep through itself."""
+    bucket = send_bucket(chat_id)
+    while True:
+        await bucket.acquire()
+        try: return await client.send_message(chat_id, text, file=file)
+        except FloodWaitError as e:
+            if e.seconds > max_flood_wait: raise
+            print(f"⏳ FloodWait of {e.seconds}s while sending to {chat_id}."); bucket.pause(e.seconds); METRICS.inc("flood_waits_total", source="send")
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- ENTITY CACHE ---
+## ----------------------------------------------------------------------------------------------------------------
+class CachedUser:
+    """Profile fields of a user (or channel) snapshot, enough for names and mentions without an API call."""
+    __slots__ = ("id", "first_name", "last_name", "username", "bot")
+    def __init__(self, id: int, first_name: str, last_name: str | None = None, username: str | None = None, bot: bool = False):
+        self.id = id; self.first_name = first_name; self.last_name = last_name; self.username = username; self.bot = bot
+    @classmethod
+    def from_entity(cls, entity) -> "CachedUser":
+        return cls(entity.id, getattr(entity, "first_name", None) or getattr(entity, "title", None) or "Deleted Account",
+                   getattr(entity, "last_name", None), getattr(entity, "username", None), bool(getattr(entity, "bot", False)))
+    def to_dict(self) -> dict: return {field: getattr(self, field) for field in self.__slots__}
+
+class EntityCache:
+    """Bounded TTL+LRU cache of user profiles, primed from incoming messages and persisted in the state store."""
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size; self.ttl = ttl
+        self.entries: OrderedDict[int, tuple] = OrderedDict()
+        self.hits = 0; self.misses = 0
+
+    async def load(self):
+        now = time.time()
+        for key, value in sorted(await STATE_STORE.load(ENTITY_SCOPE), key=lambda item: item[1]["cached_at"]):
+            if now - value["cached_at"] > self.ttl: STATE_STORE.delete(ENTITY_SCOPE, key); continue
+            self._set(CachedUser(**value["user"]), value["cached_at"], persist=False)
+        print(f"✅ Loaded {len(self.entries)} cached user profiles.")
+
+    def observe(self, entity):
+        """Records a profile seen in an update; unchanged, still-fresh entries are only touched."""
+        if entity is None or not getattr(entity, "id", None): return
+        user = CachedUser.from_entity(entity); entry = self.entries.get(user.id)
+        if entry and time.time() - entry[1] < self.ttl / 2 and entry[0].to_dict() == user.to_dict(): self.entries.move_to_end(user.id); return
+        self._set(user, time.time())
+    def peek(self, user_id: int) -> CachedUser | None:
+        """The cached profile, even if stale, without ever calling the API."""
+        entry = self.entries.get(user_id)
+        return entry[0] if entry else None
+    async def get(self, user_id: int) -> CachedUser:
+        entry = self.entries.get(user_id)
+        if entry and time.time() - entry[1] < self.ttl:
+            self.entries.move_to_end(user_id); self.hits += 1
+            return entry[0]
+        self.misses += 1
+        user = CachedUser.from_entity(await client.get_entity(user_id))
+        self._set(user, time.time())
+        return user
+    async def get_many(self, user_ids) -> list:
+        """Profiles for `user_ids` in order; entries that cannot be resolved come back as exceptions."""
+        return await asyncio.gather(*(self.get(user_id) for user_id in user_ids), return_exceptions=True)
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _set(self, user: CachedUser, cached_at: float, persist: bool = True):
+        self.entries[user.id] = (user, cached_at); self.entries.move_to_end(user.id)
+        if persist: STATE_STORE.put(ENTITY_SCOPE, user.id, {"user": user.to_dict(), "cached_at": cached_at})
+        while len(self.entries) > self.max_size:
+            evicted, _ = self.entries.popitem(last=False); STATE_STORE.delete(ENTITY_SCOPE, evicted)
+
+ENTITY_CACHE = EntityCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- LINK FILTER ---
+## ----------------------------------------------------------------------------------------------------------------
+class LinkRules:
+    """A chat's compiled antilink rules. Domains match themselves and their subdomains; `allow` wins over `deny` and invite links.
+    Telegram entries may carry a first path segment (`t.me/somechannel`) and then only match links to that channel or invite."""
+    __slots__ = ("allow", "deny")
+    def __init__(self, allow, deny):
+        self.allow = frozenset(allow); self.deny = frozenset(deny)
+    @staticmethod
+    def suffixes(host: str):
+        labels = host.split(".")
+        return (".".join(labels[i:]) for i in range(len(labels) - 1))
+    @staticmethod
+    def normalize(entry: str) -> str | None:
+        """The rule stored for a user-supplied domain or Telegram link, or None for a path on any other host, which the
+        filter cannot honour (keeping only the domain would silently widen the rule)."""
+        host, _, path = re.sub(r"^(?:https?://)?(?:www\.)?", "", entry.lower()).partition("/")
+        segment = path.split("/", 1)[0].split("?", 1)[0]
+        if not segment: return host
+        return f"{host}/{segment}" if any(suffix in INVITE_HOSTS for suffix in LinkRules.suffixes(host)) else None
+    def verdict(self, host: str, segment: str | None = None) -> str | None:
+        """'allow', 'deny', 'invite' or None; one or two set lookups per domain label, however many rules the chat has."""
+        invite = False
+        for suffix in self.suffixes(host):
+            if segment:
+                scoped = f"{suffix}/{segment}"
+                if scoped in self.allow: return "allow"
+                if scoped in self.deny: return "deny"
+            if suffix in self.allow: return "allow"
+            if suffix in self.deny: return "deny"
+            invite = invite or suffix in INVITE_HOSTS
+        return "invite" if invite else None
+
+class LinkFilter:
+    """Per-chat antilink engine: rules are compiled once per settings change and each message is scanned in one pass."""
+    def __init__(self, warning_window: int):
+        self.warning_window = warning_window
+        self.rules: Dict[int, LinkRules] = {}; self.warnings: Dict[int, list] = {}
+    def invalidate(self, chat_id: int): self.rules.pop(chat_id, None)
+    def rules_for(self, chat_id: int) -> LinkRules:
+        rules = self.rules.get(chat_id)
+        if rules is None:
+            settings = CHAT_SETTINGS.get(chat_id, {})
+            rules = self.rules[chat_id] = LinkRules(settings.get("link_allow", ()), settings.get("link_deny", ()))
+        return rules
+
+    @staticmethod
+    def links(message) -> list:
+        """`(host, first path segment)` for every link in the message text plus the hidden targets of text-URL entities."""
+        texts = [message.raw_text or ""] + [entity.url for entity in (message.entities or ()) if isinstance(entity, MessageEntityTextUrl)]
+        found = []
+        for match in LINK_SCAN_REGEX.finditer("\n".join(texts)):
+            if match.group("deeplink"):
+                domain = re.search(r"[?&]domain=(\w+)", match.group(0)); found.append(("t.me", domain.group(1).lower() if domain else None))
+            else: found.append((match.group("host").lower(), (match.group("path") or "/")[1:].split("/", 1)[0].split("?", 1)[0].lower() or None))
+        return found
+    def check(self, chat_id: int, message) -> str | None:
+        """The reason the message breaks the chat's rules ('deny' or 'invite'), or None."""
+        rules = self.rules_for(chat_id)
+        for host, segment in self.links(message):
+            verdict = rules.verdict(host, segment)
+            if verdict in ("deny", "invite"): return verdict
+        return None
+
+    def should_warn(self, chat_id: int) -> tuple:
+        """Returns `(warn, suppressed)`: one notice per chat per window, carrying the count of removals it stayed quiet about."""
+        now = time.monotonic(); state = self.warnings.setdefault(chat_id, [0.0, 0])
+        if now - state[0] < self.warning_window: state[1] += 1; return False, 0
+        suppressed = state[1]; state[0] = now; state[1] = 0
+        return True, suppressed
+
+LINK_FILTER = LinkFilter(LINK_WARNING_WINDOW)
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- MESSAGE LOG ---
+## ----------------------------------------------------------------------------------------------------------------
+class LoggedMessage:
+    __slots__ = ("id", "sender_id", "text", "media", "size", "seq")
+    RECORD_OVERHEAD = 220  # Rough per-record cost of the slots object, its ints, the buffer entry and the age-order entry.
+    SEQUENCE = itertools.count()
+    def __init__(self, id: int, sender_id: int, text: str, media):
+        self.id = id; self.sender_id = sender_id; self.text = text; self.media = media; self.seq = next(self.SEQUENCE)
+        self.size = self.RECORD_OVERHEAD + 2 * len(text) + (200 if media else 0)
+
+class MessageLog:
+    """Recent messages of antidelete chats: a ring buffer per chat plus a global memory cap that evicts the oldest records first.
+    Media is kept as an InputMedia reference (id, access hash, file reference), never as bytes."""
+    def __init__(self, per_chat: int, max_bytes: int):
+        self.per_chat = per_chat; self.max_bytes = max_bytes
+        self.chats: Dict[int, OrderedDict[int, LoggedMessage]] = {}; self.total_bytes = 0
+        self.order: OrderedDict[int, tuple] = OrderedDict()  # seq -> (chat_id, message_id), oldest record of any chat first
+
+    def record(self, chat_id: int, message):
+        media = None
+        if message.photo or message.document:
+            with contextlib.suppress(TypeError): media = utils.get_input_media(message.media)
+        if not message.message and media is None: return
+        buffer = self.chats.setdefault(chat_id, OrderedDict())
+        self._drop(buffer, message.id)
+        entry = buffer[message.id] = LoggedMessage(message.id, message.sender_id, message.message or "", media)
+        self.order[entry.seq] = (chat_id, message.id); self.total_bytes += entry.size
+        while len(buffer) > self.per_chat: self._drop(buffer, next(iter(buffer)))
+        while self.total_bytes > self.max_bytes and self.order:
+            oldest_chat, oldest_id = next(iter(self.order.values())); self._drop(self.chats[oldest_chat], oldest_id)
+    def update(self, chat_id: int, message):
+        buffer = self.chats.get(chat_id)
+        if buffer is not None and message.id in buffer: self.record(chat_id, message)
+
+    def pop(self, chat_id: int | None, message_ids) -> Dict[int, list]:
+        """Removes and returns the logged records for a deletion, grouped by chat.
+        Telegram leaves `chat_id` empty outside channels; message ids are unique per account there, so every non-channel buffer is searched."""
+        if chat_id is not None: candidates = [chat_id] if chat_id in self.chats else []
+        else: candidates = [cid for cid in self.chats if utils.resolve_id(cid)[1] is not PeerChannel]
+        found: Dict[int, list] = {}
+        for message_id in message_ids:
+            for cid in candidates:
+                entry = self._drop(self.chats[cid], message_id)
+                if entry: found.setdefault(cid, []).append(entry); break
+        return found
+    def forget(self, chat_id: int, message_ids):
+        """Used before the bot itself deletes messages, so they are not reposted."""
+        buffer = self.chats.get(chat_id)
+        if buffer is not None:
+            for message_id in message_ids: self._drop(buffer, message_id)
+    def clear(self, chat_id: int):
+        for entry in self.chats.pop(chat_id, {}).values(): self.total_bytes -= entry.size; self.order.pop(entry.seq, None)
+
+    def _drop(self, buffer: OrderedDict, message_id: int) -> LoggedMessage | None:
+        entry = buffer.pop(message_id, None)
+        if entry: self.total_bytes -= entry.size; self.order.pop(entry.seq, None)
+        return entry
+
+MESSAGE_LOG = MessageLog(ANTIDELETE_PER_CHAT, ANTIDELETE_MAX_BYTES)
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- AI COMPLETIONS ---
+## ----------------------------------------------------------------------------------------------------------------
+class CompletionError(Exception):
+    """Raised when the completion API answers with an error status, an error event or nothing at all."""
+
+class ChatCompletions:
+    """Streams chat completions from an OpenAI-compatible endpoint. Answers are cached by the exact conversation sent
+    (TTL+LRU), at most `concurrency` streams run at once, and with `context_turns` each chat resends its last exchanges."""
+    def __init__(self, concurrency: int, cache_size: int, ttl: int, context_turns: int, context_chars: int, context_chats: int):
+        self.slots = asyncio.Semaphore(concurrency); self.concurrency = concurrency
+        self.cache_size = cache_size; self.ttl = ttl; self.cache: OrderedDict[str, tuple] = OrderedDict()
+        self.context_turns = context_turns; self.context_chars = context_chars; self.context_chats = context_chats
+        self.contexts: OrderedDict[int, deque] = OrderedDict()
+        self.hits = 0; self.misses = 0; self.streaming = 0
+
+    def conversation(self, chat_id: int, prompt: str) -> list:
+        messages = []
+        for question, answer in self.contexts.get(chat_id, ()): messages += [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+        return messages + [{"role": "user", "content": prompt}]
+    def remember(self, chat_id: int, prompt: str, answer: str):
+        if not self.context_turns: return
+        turns = self.contexts.pop(chat_id, None) or deque(maxlen=self.context_turns); turns.append((prompt, answer))
+        while len(turns) > 1 and sum(len(q) + len(a) for q, a in turns) > self.context_chars: turns.popleft()
+        self.contexts[chat_id] = turns
+        while len(self.contexts) > self.context_chats: self.contexts.popitem(last=False)
+    def forget(self, chat_id: int) -> bool: return self.contexts.pop(chat_id, None) is not None
+
+    @staticmethod
+    def cache_key(messages: list) -> str: return hashlib.sha256(json.dumps([GPT_MODEL, messages], ensure_ascii=False).encode()).hexdigest()
+    def cached(self, key: str) -> str | None:
+        entry = self.cache.get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None: del self.cache[key]
+            return None
+        self.cache.move_to_end(key); self.hits += 1
+        return entry[1]
+
+    async def stream(self, messages: list):
+        """Yields content deltas from the server-sent event stream as they arrive."""
+        payload = {"model": GPT_MODEL, "messages": messages, "temperature": 0.7, "max_tokens": GPT_MAX_TOKENS, "stream": True}
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+        async with get_http_session().post(GPT_API_URL, headers={"Authorization": f"Bearer {GPT_API_KEY}"}, json=payload, timeout=timeout) as resp:
+            if resp.status != 200: raise CompletionError(f"API error `{resp.status}`:\n`{(await resp.text())[:500]}`")
+            async for line in resp.content:
+                if not line.startswith(b"data:"): continue
+                data = line[5:].strip()
+                if data == b"[DONE]": return
+                chunk = json.loads(data)
+                if chunk.get("error"): raise CompletionError(f"API error: `{chunk['error'].get('message', chunk['error']) if isinstance(chunk['error'], dict) else chunk['error']}`")
+                for choice in chunk.get("choices") or ():
+                    delta = (choice.get("delta") or {}).get("content")
+                    if delta: yield delta
+        # A stream that ends without [DONE] was cut off; its partial answer must not be shown as final or cached.
+        raise CompletionError("The response stream ended before the answer was complete.")
+    async def complete(self, chat_id: int, prompt: str, on_progress, on_queued=None) -> tuple[str, bool]:
+        """Answers `prompt` in the chat's context, calling `on_progress(text)` at most every GPT_STREAM_INTERVAL seconds
+        while streaming. Returns the answer and whether it came from the cache."""
+        messages = self.conversation(chat_id, prompt); key = self.cache_key(messages)
+        answer = self.cached(key); from_cache = answer is not None
+        if not from_cache:
+            self.misses += 1
+            if self.slots.locked() and on_queued: await on_queued()
+            async with self.slots:
+                self.streaming += 1; parts = []; start = last = time.monotonic()
+                try:
+                    async for delta in self.stream(messages):
+                        if not parts: METRICS.observe("gpt_first_token_seconds", time.monotonic() - start)
+                        parts.append(delta)
+                        if time.monotonic() - last >= GPT_STREAM_INTERVAL: last = time.monotonic(); await on_progress("".join(parts))
+                finally: self.streaming -= 1
+            answer = "".join(parts).strip()
+            if not answer: raise CompletionError("The model returned an empty response.")
+            self.cache[key] = (time.time() + self.ttl, answer); self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size: self.cache.popitem(last=False)
+        self.remember(chat_id, prompt, answer)
+        return answer, from_cache
+
+COMPLETIONS = ChatCompletions(GPT_CONCURRENCY, GPT_CACHE_SIZE, GPT_CACHE_TTL, GPT_CONTEXT_TURNS, GPT_CONTEXT_CHARS, GPT_CONTEXT_CHATS)
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- METRICS ---
+## ----------------------------------------------------------------------------------------------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1); self.sum = 0.0; self.count = 0
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1; self.sum += value; self.count += 1
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation."""
+        running = 0
+        for i, count in enumerate(self.counts):
+            running += count
+            if running >= q * self.count: return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+        return 0.0
+
+class Metrics:
+    """In-process counters and histograms, plus gauges read from existing state only when someone looks.
+    Recording is a dict update, cheap enough to leave on for every command and media job."""
+    def __init__(self, prefix: str):
+        self.prefix = prefix; self.counters: Dict[tuple, float] = {}; self.histograms: Dict[tuple, Histogram] = {}
+        self.collectors: Dict[str, tuple] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items()))); self.counters[key] = self.counters.get(key, 0) + value
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None: histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+    def timer(self, name: str, **labels) -> "_Timer":
+        """Observes the time spent inside a `with` or `async with` block."""
+        return _Timer(self, name, labels)
+    def collector(self, name: str, kind: str = "gauge"):
+        """Registers `func() -> number | {label_tuple: number}` to be read at export time."""
+        def decorator(func): self.collectors[name] = (kind, func); return func
+        return decorator
+
+    def collect(self, name: str) -> dict:
+        values = self.collectors[name][1]()
+        return values if isinstance(values, dict) else {(): values}
+    def series(self, name: str) -> dict:
+        return {labels: value for (metric, labels), value in self.counters.items() if metric == name}
+    def render_prometheus(self) -> str:
+        def fmt(labels) -> str: return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+        lines = []; counters: Dict[str, list] = {}; histograms: Dict[str, list] = {}
+        for (name, labels), value in self.counters.items(): counters.setdefault(name, []).append((labels, value))
+        for (name, labels), histogram in self.histograms.items(): histograms.setdefault(name, []).append((labels, histogram))
+        for name, samples in counters.items():
+            lines.append(f"# TYPE {self.prefix}{name} counter"); lines.extend(f"{self.prefix}{name}{fmt(labels)} {value}" for labels, value in samples)
+        for name, (kind, _) in self.collectors.items():
+            try: values = self.collect(name)
+            except Exception as e: print(f"⚠️ Metric {name} failed: {e}"); continue
+            lines.append(f"# TYPE {self.prefix}{name} {kind}"); lines.extend(f"{self.prefix}{name}{fmt(labels)} {value}" for labels, value in values.items())
+        for name, samples in histograms.items():
+            lines.append(f"# TYPE {self.prefix}{name} histogram")
+            for labels, histogram in samples:
+                running = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                    running += count; lines.append(f"{self.prefix}{name}_bucket{fmt(labels + (('le', bound),))} {running}")
+                lines.append(f"{self.prefix}{name}_sum{fmt(labels)} {histogram.sum}"); lines.append(f"{self.prefix}{name}_count{fmt(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "start")
+    def __init__(self, metrics: Metrics, name: str, labels: dict):
+        self.metrics = metrics; self.name = name; self.labels = labels
+    def __enter__(self): self.start = time.perf_counter()
+    def __exit__(self, *exc): self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+    async def __aenter__(self): self.__enter__()
+    async def __aexit__(self, *exc): self.__exit__()
+
+METRICS = Metrics("userbot_")
+LOOP_LAG = {"last": 0.0}
+
+METRICS.collector("uptime_seconds")(lambda: time.monotonic() - START_TIME)
+METRICS.collector("event_loop_lag_last_seconds")(lambda: LOOP_LAG["last"])
+METRICS.collector("media_jobs_in_progress")(lambda: sum(ACTIVE_DOWNLOADS.values()))
+METRICS.collector("media_stage_active")(lambda: {(("stage", name),): stage.active for name, stage in MEDIA_STAGES.items()})
+METRICS.collector("media_stage_queued")(lambda: {(("stage", name),): stage.queued() for name, stage in MEDIA_STAGES.items()})
+METRICS.collector("media_worker_slots_free")(lambda: MEDIA_WORKER_QUEUE - MEDIA_WORKER_SLOTS_USED)
+METRICS.collector("gpt_streams_active")(lambda: COMPLETIONS.streaming)
+METRICS.collector("status_edits_pending")(lambda: len(STATUS_EDITOR.pending))
+METRICS.collector("status_edits_total", "counter")(lambda: {(("result", "sent"),): STATUS_EDITOR.edits, (("result", "skipped"),): STATUS_EDITOR.skipped})
+METRICS.collector("transfer_bytes_total", "counter")(lambda: {(("direction", "download"),): DOWNLOAD_RATE.total, (("direction", "upload"),): UPLOAD_RATE.total})
+METRICS.collector("transfer_bytes_per_second")(lambda: {(("direction", "download"),): DOWNLOAD_RATE.rate(), (("direction", "upload"),): UPLOAD_RATE.rate()})
+METRICS.collector("cache_lookups_total", "counter")(lambda: {(("cache", name), ("result", result)): value for name, cache in (("media", MEDIA_CACHE), ("search", SEARCH_BACKEND), ("entity", ENTITY_CACHE), ("gpt", COMPLETIONS), ("tts", SPEECH))
+                                                             for result, value in (("hit", cache.hits), ("miss", cache.misses))})
+METRICS.collector("media_cache_bytes")(lambda: MEDIA_CACHE.total_bytes)
+METRICS.collector("message_log_bytes")(lambda: MESSAGE_LOG.total_bytes)
+
+async def monitor_loop_lag():
+    """Samples how late the event loop wakes up from a short sleep; anything above zero is time handlers spent blocking it."""
+    while True:
+        start = time.monotonic(); await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG["last"] = lag = max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL); METRICS.observe("event_loop_lag_seconds", lag)
+def count_telethon_flood_waits():
+    """Counts the FloodWaits Telethon sleeps through by itself (those under its `flood_sleep_threshold`, upload parts and
+    sends included), which never reach our except blocks. Telethon only logs them, so a filter on its logger does the
+    counting; records are still passed on only at the level they would have been shown before."""
+    logger = logging.getLogger("telethon.client.users"); shown_level = logger.getEffectiveLevel()
+    def on_record(record: logging.LogRecord) -> bool:
+        # ('Sleeping%s for %ds (%s) on %s flood wait', early, seconds, timedelta, request); "early" re-waits a known FloodWait.
+        if isinstance(record.msg, str) and record.msg.endswith("flood wait") and len(record.args) == 4 and not record.args[0]:
+            METRICS.inc("flood_waits_total", source="telethon", request=record.args[3])
+        return record.levelno >= shown_level
+    logger.setLevel(min(shown_level, logging.INFO)); logger.addFilter(on_record)
+async def start_metrics_server():
+    """Serves Prometheus text format on METRICS_HOST:METRICS_PORT. Returns the runner to clean up, or None when disabled."""
+    if not METRICS_PORT: return None
+    from aiohttp import web
+    async def handle(request): return web.Response(text=METRICS.render_prometheus(), content_type="text/plain", charset="utf-8")
+    app = web.Application(); app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None); await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"📈 Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+## ----------------------------------------------------------------------------------------------------------------
+## --- COMMAND DISPATCH ---
+## ----------------------------------------------------------------------------------------------------------------
+# A single NewMessage handler parses the leading `/command` token once and looks it up in COMMANDS, instead of
+# every handler running its own regex against every message. Auth, sudo and cooldown checks live here as well.
+COMMAND_REGEX = re.compile(r'^/(\w+)(?:\s|$)')
+COMMANDS: Dict[str, tuple] = {}
+MESSAGE_WATCHERS: list = []
+
+def command(*names: str, access: str = "auth", cooldown: bool = True):
+    """Registers a handler for `/name`. `access` is "auth" (AUTH_USERS), "sudo" (SUDO_USER only) or "all"."""
+    def decorator(func):
+        for name in names: COMMANDS[name] = (func, access, cooldown)
+        return func
+    return decorator
+def watcher(predicate):
+    """Registers a handler for non-command traffic. It is only awaited when the synchronous `predicate` passes."""
+    def decorator(func):
+        MESSAGE_WATCHERS.append((predicate, func)); return func
+    return decorator
+def is_allowed(sender_id: int, access: str) -> bool:
+    if access == "sudo": return sender_id == SUDO_USER
+    if access == "auth": return sender_id in AUTH_USERS
+    return True
+def parse_command(text: str):
+    """Returns `(match, entry)` for a registered command, or `None`. `match.group(1)` is the command name."""
+    if not text or text[0] != '/': return None
+    match = COMMAND_REGEX.match(text)
+    if not match: return None
+    entry = COMMANDS.get(match.group(1))
+    return (match, entry) if entry else None
+@client.on(events.NewMessage)
+async def dispatch_message(event):
+    ENTITY_CACHE.observe(event.sender)
+    for predicate, func in MESSAGE_WATCHERS:
+        if not predicate(event): continue
+        try: await func(event)
+        except Exception as e: print(f"Error in {func.__name__}: {e}")
+    parsed = parse_command(event.raw_text)
+    if not parsed: return
+    match, (func, access, cooldown) = parsed
+    if not is_allowed(event.sender_id, access): return
+    if cooldown and is_on_cooldown(event.sender_id): return
+    event.pattern_match = match; start = time.perf_counter()
+    try: await func(event)
+    finally:
+        METRICS.observe("command_seconds", time.perf_counter() - start, command=match.group(1))
+        if "first_command" not in STARTUP:
+            STARTUP["first_command"] = time.monotonic() - BOOT_TIME; print(f"⏱️ First command handled {STARTUP['first_command']:.2f}s after launch.")
 
 ## ----------------------------------------------------------------------------------------------------------------
 ## --- USER ADMINISTRATION & MENUS ---
 ## ----------------------------------------------------------------------------------------------------------------
 
-@client.on(events.NewMessage(pattern=r'^/listusers(?:\s|$)', from_users=SUDO_USER))
+@command("listusers", access="sudo")
 async def list_users(event):
-    if is_on_cooldown(event.sender_id): return
     status_msg = await event.edit("`Fetching user details...`")
     
     uids = sorted(list(AUTH_USERS))
-    tasks = [client.get_entity(uid) for uid in uids]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    results = await ENTITY_CACHE.get_many(uids)
 
     msg = "**👥 Authorized Users:**\n\n"
     for i, user in enumerate(results):
@@ -202,6 +1720,7 @@ STATIC_MENU_USER = """
 ---
 **🎵 Media Commands**
 • `/play <query>`: Searches and sends a song.
+• `/play -l <query>`: Lists the top search results.
 • `/ytmp3 <url>`: Sends YouTube audio.
 • `/ytmp4 <url>`: Sends YouTube video.
 • `/fbmp4 <url>`: Sends a Facebook video.
@@ -213,7 +1732,7 @@ STATIC_MENU_USER = """
 • `/toimage <reply>`: Converts replied-to static sticker to an image.
 • `/tovnote <reply>`: Converts replied-to text to a voice note.
 • `/vv <reply>`: Reveals view-once media.
-• `/gpt <prompt>`: Chat with an AI assistant.
+• `/gpt <prompt>`: Chat with an AI assistant (`-c` clears this chat's context).
 • `/pickup`: Sends a random pickup line.
 ---
 **⚙️ Utility Commands**
@@ -239,6 +1758,7 @@ STATIC_MENU_ADMIN = """
 ---
 **🔧 Auto-Mod `(Sudo)`**
 • `/antilink on|off`
+• `/antilink allow|deny|remove <domain|t.me/name>` | `/antilink list`
 • `/antidelete on|off`
 • `/setwelcome on|off [message]`
 ---
@@ -249,7 +1769,8 @@ STATIC_MENU_ADMIN = """
 **👑 User Admin `(Sudo)`**
 • `/adduser` & `/deluser` `<id|reply>`
 • `/listusers`
-• `/shell <command>`
+• `/shell <command>` | `/cancel <job id>`
+• `/stats`
 ---
 *This menu also includes all commands from the regular `/menu`.*
 """
@@ -269,57 +1790,75 @@ if BOT_TOKEN:
         if page == "main": await event.edit(back_text, buttons=back_buttons)
         elif page in MENU_TEXTS: await event.edit(MENU_TEXTS[page], buttons=[Button.inline("« Back", b"menu_main")])
         await event.answer()
-@client.on(events.NewMessage(pattern=r'^/menu(?:\s|$)'))
+@command("menu")
 async def menu_handler(event):
-    if event.sender_id not in AUTH_USERS: return
-    if is_on_cooldown(event.sender_id): return
     if BOT_TOKEN: await event.reply(MENU_MAIN_TEXT, buttons=USER_BUTTONS)
     else: await event.edit(STATIC_MENU_USER, link_preview=False)
-@client.on(events.NewMessage(pattern=r'^/menuadmin(?:\s|$)'))
+@command("menuadmin", access="sudo")
 async def menu_admin_handler(event):
-    if event.sender_id != SUDO_USER: return
-    if is_on_cooldown(event.sender_id): return
     if BOT_TOKEN: await event.reply(MENU_ADMIN_TEXT, buttons=ADMIN_BUTTONS)
     else: await event.edit(STATIC_MENU_ADMIN, link_preview=False)
-@client.on(events.NewMessage(pattern=r'^/ping(?:\s|$)'))
+@command("ping")
 async def ping_handler(event):
-    if event.sender_id not in AUTH_USERS: return
-    if is_on_cooldown(event.sender_id): return
     start_time = time.monotonic(); msg = await event.edit("...") if event.out else await event.reply("...")
     end_time = time.monotonic()
     await msg.edit(f"**Pong!**\n`{end_time - start_time:.3f}` seconds")
-@client.on(events.NewMessage(pattern=r'^/uptime(?:\s|$)'))
+@command("uptime")
 async def uptime_handler(event):
-    if event.sender_id not in AUTH_USERS: return
-    if is_on_cooldown(event.sender_id): return
     uptime_seconds = time.monotonic() - START_TIME
     await event.edit(f"**Bot Uptime:** `{get_readable_time(int(uptime_seconds))}`")
-@client.on(events.NewMessage(pattern=r'^/info(?:\s|$)'))
+@command("stats", access="sudo")
+async def stats_handler(event):
+    def ms(seconds: float) -> str: return "∞" if seconds == float("inf") else f"{seconds * 1000:.0f}ms"
+    def ratio(cache) -> str:
+        total = cache.hits + cache.misses
+        return f"{cache.hits / total:.0%} of {total}" if total else "n/a"
+    commands = sorted(((dict(labels)["command"], h) for (name, labels), h in METRICS.histograms.items() if name == "command_seconds"), key=lambda item: -item[1].count)
+    lag = METRICS.histograms.get(("event_loop_lag_seconds", ()))
+    flood_waits = sum(METRICS.series("flood_waits_total").values())
+    requests = {dict(labels)["result"]: int(value) for labels, value in METRICS.series("media_requests_total").items()}
+    voice = {dict(labels)["result"]: int(value) for labels, value in METRICS.series("tts_requests_total").items()}
+    lines = [f"**📊 Bot Stats** — up `{get_readable_time(int(time.monotonic() - START_TIME))}`", "",
+             "**Commands** `(calls · p50 · p99)`"]
+    lines += [f"• `/{name}` {h.count} · {ms(h.quantile(0.5))} · {ms(h.quantile(0.99))}" for name, h in commands[:10]] or ["• none yet"]
+    lines += ["", "**Queues**", f"• Media jobs: `{sum(ACTIVE_DOWNLOADS.values())}`",
+              *(f"• {name.capitalize()}: `{stage.active}/{stage.limit}` active, `{stage.queued()}` waiting" for name, stage in MEDIA_STAGES.items()),
+              f"• GPT streams: `{COMPLETIONS.streaming}/{COMPLETIONS.concurrency}`", f"• Status edits pending: `{len(STATUS_EDITOR.pending)}`",
+              "", "**Caches**", f"• Media requests: `{requests.get('file_ref', 0)}` by reference, `{requests.get('cache', 0)}` cached, `{requests.get('download', 0)}` downloaded",
+              f"• Voice notes: `{voice.get('file_ref', 0)}` by reference, `{voice.get('cache', 0)}` cached, `{voice.get('synthesized', 0)}` synthesized",
+              f"• Download cache: `{ratio(MEDIA_CACHE)}` ({human_readable_size(MEDIA_CACHE.total_bytes)})",
+              f"• Search cache: `{ratio(SEARCH_BACKEND)}`", f"• Entity cache: `{ratio(ENTITY_CACHE)}`", f"• GPT cache: `{ratio(COMPLETIONS)}`",
+              "", "**Throughput**", f"• Download: `{human_readable_size(DOWNLOAD_RATE.rate())}/s` ({human_readable_size(DOWNLOAD_RATE.total)} total)",
+              f"• Upload: `{human_readable_size(UPLOAD_RATE.rate())}/s` ({human_readable_size(UPLOAD_RATE.total)} total)",
+              "", "**Health**", f"• FloodWaits: `{int(flood_waits)}`", f"• Peak RSS: `{peak_rss_mb():.0f} MiB`",
+              f"• Startup: ready `{STARTUP.get('ready', 0):.2f}s` (connect `{STARTUP.get('connect', 0):.2f}s`), first command "
+              + (f"`{STARTUP['first_command']:.2f}s`" if "first_command" in STARTUP else "`n/a`"),
+              f"• Loop lag: `{ms(LOOP_LAG['last'])}` now, p99 `{ms(lag.quantile(0.99)) if lag else 'n/a'}`"]
+    await event.edit("\n".join(lines))
+async def get_target_user(event) -> CachedUser:
+    """The replied-to message's sender, or the command's sender, without refetching what the update already carried."""
+    message = await event.get_reply_message() if event.is_reply else event.message
+    if message.sender: ENTITY_CACHE.observe(message.sender); return CachedUser.from_entity(message.sender)
+    return await ENTITY_CACHE.get(message.sender_id)
+@command("info")
 async def info_handler(event):
-    if event.sender_id not in AUTH_USERS: return
-    if is_on_cooldown(event.sender_id): return
-    target = event.sender
-    if event.is_reply: target = await (await event.get_reply_message()).get_sender()
+    target = await get_target_user(event)
     info_msg = (f"**User Info:**\n"
                 f"**ID:** `{target.id}`\n**First Name:** `{target.first_name}`\n"
                 f"**Last Name:** `{target.last_name or 'N/A'}`\n"
-                f"**Username:** `@{target.username}`\n" if target.username else ""
-                f"**Profile Link:** [Click here](tg://user?id={target.id})\n**Is Bot:** `{target.bot}`")
+                + (f"**Username:** `@{target.username}`\n" if target.username else "")
+                + f"**Profile Link:** [Click here](tg://user?id={target.id})\n**Is Bot:** `{target.bot}`")
     await event.edit(info_msg)
-@client.on(events.NewMessage(pattern=r'^/pp(?:\s|$)'))
+@command("pp")
 async def pp_handler(event):
-    if event.sender_id not in AUTH_USERS: return
-    if is_on_cooldown(event.sender_id): return
-    target = event.sender
-    if event.is_reply: target = await (await event.get_reply_message()).get_sender()
-    photos = await client.get_profile_photos(target)
+    target = await get_target_user(event)  # Display fields only: a cached id may have no access hash in this session.
+    message = await event.get_reply_message() if event.is_reply else event.message
+    photos = await client.get_profile_photos(await message.get_input_sender() or target.id)
     if not photos: return await event.edit("This user has no profile pictures.")
     await event.delete()
     await client.send_file(event.chat_id, photos[0], caption=f"Profile picture of `{target.first_name}`.")
-@client.on(events.NewMessage(pattern=r'^/vv(?:\s|$)'))
+@command("vv")
 async def vv_handler(event):
-    if event.sender_id not in AUTH_USERS: return
-    if is_on_cooldown(event.sender_id): return
     if not event.is_reply: return await event.edit("⚠️ Reply to a view-once message.")
     reply_msg = await event.get_reply_message()
     if not reply_msg or not reply_msg.media: return await event.edit("🚫 Replied message is not a media file.")
@@ -329,110 +1868,88 @@ async def vv_handler(event):
         await client.send_file(event.chat_id, file_path, caption="🔓 View-once media revealed.")
         os.remove(file_path); await status_msg.delete()
     except Exception as e: await status_msg.edit(f"🚫 **Error:** {e}")
-@client.on(events.NewMessage(pattern=r'^/sticker(?:\s|$)'))
+@command("sticker")
 async def sticker_handler(event):
-    if event.sender_id not in AUTH_USERS: return
-    if is_on_cooldown(event.sender_id): return
     if not event.is_reply: return await event.edit("⚠️ Reply to an image to make a sticker.")
     reply_msg = await event.get_reply_message()
     if not reply_msg or not reply_msg.photo: return await event.edit("🚫 Replied message is not a photo.")
     status_msg = await event.edit("`Creating sticker...`")
-    img_path = await client.download_media(reply_msg.photo)
-    sticker_path = os.path.join(CACHE_DIRECTORY, "sticker.webp")
     try:
-        with Image.open(img_path) as im: im.thumbnail((512, 512)); im.save(sticker_path, "WEBP")
-        await client.send_file(event.chat_id, sticker_path); await status_msg.delete()
+        image = await client.download_media(reply_msg.photo, file=bytes)
+        sticker = await run_media_task(make_sticker, image)
+        await client.send_file(event.chat_id, named_buffer(sticker, "sticker.webp")); await status_msg.delete()
     except Exception as e: await status_msg.edit(f"🚫 **Error:** {e}")
-    finally:
-        if os.path.exists(img_path): os.remove(img_path)
-        if os.path.exists(sticker_path): os.remove(sticker_path)
-@client.on(events.NewMessage(pattern=r'^/toimage(?:\s|$)'))
+@command("toimage")
 async def to_image_handler(event):
-    if event.sender_id not in AUTH_USERS: return
-    if is_on_cooldown(event.sender_id): return
     if not event.is_reply: return await event.edit("⚠️ Reply to a sticker.")
     reply_msg = await event.get_reply_message()
     if not reply_msg or not reply_msg.sticker: return await event.edit("🚫 Replied message is not a sticker.")
+    if reply_msg.sticker.mime_type != "image/webp": return await event.edit("🚫 This bot currently only supports converting static `.webp` stickers.")
     status_msg = await event.edit("`Converting sticker...`")
-    sticker_path = await client.download_media(reply_msg.sticker)
-    img_path = os.path.join(CACHE_DIRECTORY, "image.jpg")
     try:
-        if sticker_path.endswith('.webp'):
-            with Image.open(sticker_path) as im: im.save(img_path, "JPEG")
-            await client.send_file(event.chat_id, img_path); await status_msg.delete()
-        else: await status_msg.edit("🚫 This bot currently only supports converting static `.webp` stickers.")
+        sticker = await client.download_media(reply_msg.sticker, file=bytes)
+        image = await run_media_task(sticker_to_image, sticker)
+        await client.send_file(event.chat_id, named_buffer(image, "image.jpg")); await status_msg.delete()
     except Exception as e: await status_msg.edit(f"🚫 **Error:** {e}")
-    finally:
-        if os.path.exists(sticker_path): os.remove(sticker_path)
-        if os.path.exists(img_path): os.remove(img_path)
-@client.on(events.NewMessage(pattern=r'^/tovnote(?:\s|$)'))
+@command("tovnote")
 async def to_vnote_handler(event):
-    if event.sender_id not in AUTH_USERS: return
-    if is_on_cooldown(event.sender_id): return
     if not event.is_reply: return await event.edit("⚠️ Reply to a text message.")
     reply_msg = await event.get_reply_message()
     if not reply_msg or not reply_msg.text: return await event.edit("🚫 Replied message has no text.")
     status_msg = await event.edit("`Converting to voice note...`")
-    vnote_path = os.path.join(CACHE_DIRECTORY, "voice.ogg")
     try:
-        tts = await run_sync_in_executor(lambda: gTTS(reply_msg.text))
-        tts.save(vnote_path)
-        await client.send_file(event.chat_id, vnote_path, voice_note=True); await status_msg.delete()
+        METRICS.inc("tts_requests_total", result=await SPEECH.send(event.chat_id, reply_msg.raw_text)); await status_msg.delete()
     except Exception as e: await status_msg.edit(f"🚫 **Error:** {e}")
-    finally:
-        if os.path.exists(vnote_path): os.remove(vnote_path)
-@client.on(events.NewMessage(pattern=r'^/gpt(?:\s|$)'))
+@command("gpt")
 async def gpt_handler(event):
-    if event.sender_id not in AUTH_USERS: return
-    if is_on_cooldown(event.sender_id): return
     if not GPT_API_KEY: return await event.edit("🚫 **GPT Error:** `GPT_API_KEY` is not set in the `.env` file.")
-    try: _, prompt = event.text.split(' ', 1)
-    except (ValueError, IndexError): return await event.edit("📋 **Usage:** `/gpt <prompt>`")
-    status_msg = await event.edit("🤖 **Thinking...**")
+    try: _, prompt = event.text.split(' ', 1); prompt = prompt.strip()
+    except (ValueError, IndexError): prompt = ""
+    if prompt == "-c": return await event.edit("🧹 Conversation context cleared." if COMPLETIONS.forget(event.chat_id) else "ℹ️ No conversation context to clear.")
+    if not prompt: return await event.edit("📋 **Usage:** `/gpt <prompt>` or `/gpt -c` to clear this chat's context")
+    status_msg = await event.edit("🤖 **Thinking...**"); title = "**💡 Response:**"; room = MESSAGE_LENGTH_LIMIT - utf16_length(title) - 4
+    async def on_progress(text: str):
+        preview = text if utf16_length(text) <= room else "…" + utf16_slice(text, room - 1, tail=True)
+        await STATUS_EDITOR.edit(status_msg, f"{title}\n\n{preview} ▌", wait=False, link_preview=False)
+    async def on_queued(): await STATUS_EDITOR.edit(status_msg, "🕒 **Waiting for a free slot...**", wait=False)
     try:
-        url = "https://api.together.xyz/v1/chat/completions"; headers = {"Authorization": f"Bearer {GPT_API_KEY}"}
-        payload = {"model": "mistralai/Mixtral-8x7B-Instruct-v0.1", "messages": [{"role": "user", "content": prompt}], "temperature": 0.7, "max_tokens": 1500}
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=payload) as resp:
-                if resp.status == 200:
-                    result = await resp.json(); reply = result["choices"][0]["message"]["content"]
-                    await status_msg.edit(f"**💡 Response:**\n\n{reply}")
-                else: await status_msg.edit(f"⚠️ API error `{resp.status}`:\n`{await resp.text()}`")
-    except Exception as e: await status_msg.edit(f"🚫 **Error:** {e}")
-@client.on(events.NewMessage(pattern=r'^/pickup(?:\s|$)'))
+        with METRICS.timer("gpt_seconds"): answer, from_cache = await COMPLETIONS.complete(event.chat_id, prompt, on_progress, on_queued)
+        METRICS.inc("gpt_requests_total", result="cache" if from_cache else "stream")
+        chunks = list(pack_lines(answer.split("\n"), title))
+        await STATUS_EDITOR.edit(status_msg, chunks[0], link_preview=False)
+        for chunk in chunks[1:]: await send_paced(event.chat_id, chunk)
+    except Exception as e:
+        METRICS.inc("gpt_requests_total", result="error"); await STATUS_EDITOR.edit(status_msg, f"🚫 **Error:** {e}")
+@command("pickup")
 async def pickup_handler(event):
-    if event.sender_id not in AUTH_USERS: return
-    if is_on_cooldown(event.sender_id): return
     pickup_lines = [ "Are you a magician? Because whenever I look at you, everyone else disappears. ✨", "Do you have a map? I just got lost in your eyes. 😍", "Is your name Google? Because you have everything I’ve been searching for. 🔍❤️"]
     await event.edit(random.choice(pickup_lines))
 MUTE_RIGHTS = ChatBannedRights(until_date=None, send_messages=True)
 UNMUTE_RIGHTS = ChatBannedRights(until_date=None, send_messages=False)
-@client.on(events.NewMessage(pattern=r'^/(ban|unban|mute|unmute|kick|promote|demote)(?:\s|$)', from_users=SUDO_USER))
+@command("ban", "unban", "mute", "unmute", "kick", "promote", "demote", access="sudo")
 async def moderation_handler(event):
-    if is_on_cooldown(event.sender_id): return
     command = event.pattern_match.group(1)
     if not event.is_group: return await event.edit("❌ This command only works in groups.")
     if not event.is_reply: return await event.edit(f"⚠️ Please reply to a user's message to `{command}` them.")
-    reply_msg = await event.get_reply_message(); target_user = await client.get_entity(reply_msg.sender_id); chat = await event.get_chat()
+    reply_msg = await event.get_reply_message(); target = await get_target_user(event); target_user = await reply_msg.get_input_sender(); chat = await event.get_input_chat()
     try:
         if command == "ban":
-            await client(EditBannedRequest(chat, target_user, ChatBannedRights(until_date=None, view_messages=True))); await event.edit(f"**Banned** `{target_user.first_name}`.")
+            await client(EditBannedRequest(chat, target_user, ChatBannedRights(until_date=None, view_messages=True))); await event.edit(f"**Banned** `{target.first_name}`.")
         elif command == "unban":
-            await client(EditBannedRequest(chat, target_user, ChatBannedRights(until_date=None, view_messages=False))); await event.edit(f"**Unbanned** `{target_user.first_name}`.")
+            await client(EditBannedRequest(chat, target_user, ChatBannedRights(until_date=None, view_messages=False))); await event.edit(f"**Unbanned** `{target.first_name}`.")
         elif command == "mute":
-            await client(EditBannedRequest(chat, target_user, MUTE_RIGHTS)); await event.edit(f"**Muted** `{target_user.first_name}`.")
+            await client(EditBannedRequest(chat, target_user, MUTE_RIGHTS)); await event.edit(f"**Muted** `{target.first_name}`.")
         elif command == "unmute":
-            await client(EditBannedRequest(chat, target_user, UNMUTE_RIGHTS)); await event.edit(f"**Unmuted** `{target_user.first_name}`.")
+            await client(EditBannedRequest(chat, target_user, UNMUTE_RIGHTS)); await event.edit(f"**Unmuted** `{target.first_name}`.")
         elif command == "kick":
-            await client.kick_participant(event.chat_id, target_user.id); await event.edit(f"**Kicked** `{target_user.first_name}`.")
+            await client.kick_participant(event.chat_id, target_user); await event.edit(f"**Kicked** `{target.first_name}`.")
         elif command == "promote":
-            await client.edit_admin(event.chat_id, target_user, is_admin=True, title="Admin"); await event.edit(f"**Promoted** `{target_user.first_name}`.")
+            await client.edit_admin(event.chat_id, target_user, is_admin=True, title="Admin"); await event.edit(f"**Promoted** `{target.first_name}`.")
         elif command == "demote":
-            await client.edit_admin(event.chat_id, target_user, is_admin=False); await event.edit(f"**Demoted** `{target_user.first_name}`.")
+            await client.edit_admin(event.chat_id, target_user, is_admin=False); await event.edit(f"**Demoted** `{target.first_name}`.")
     except Exception as e: await event.edit(f"🚫 **Error:** {e}\n\nDo I have admin rights here?")
-@client.on(events.NewMessage(pattern=r'^/(pin|unpin)(?:\s|$)', from_users=SUDO_USER))
+@command("pin", "unpin", access="sudo")
 async def pin_handler(event):
-    if is_on_cooldown(event.sender_id): return
     command = event.pattern_match.group(1)
     try:
         if command == "pin":
@@ -446,31 +1963,26 @@ async def pin_handler(event):
             else:
                 await client.unpin_message(event.chat_id); await event.edit("**Unpinned** the latest message.")
     except Exception as e: await event.edit(f"🚫 **Error:** {e}\n\nDo I have permission to pin messages?")
-@client.on(events.NewMessage(pattern=r'^/del(?:\s|$)', from_users=SUDO_USER))
+@command("del", access="sudo")
 async def delete_handler(event):
-    if is_on_cooldown(event.sender_id): return
     if not event.is_reply: return await event.edit("Reply to a message to delete it.")
-    reply_msg = await event.get_reply_message()
+    reply_msg = await event.get_reply_message(); MESSAGE_LOG.forget(event.chat_id, [reply_msg.id])
     try: await reply_msg.delete(); await event.delete()
     except Exception as e: await event.edit(f"🚫 **Error:** {e}")
-@client.on(events.NewMessage(pattern=r'^/tagall(?:\s|$)', from_users=SUDO_USER))
+@command("tagall", access="sudo")
 async def tag_all_handler(event):
-    if is_on_cooldown(event.sender_id): return
     if not event.is_group: return await event.edit("This command can only be used in groups.")
     try: _, message = event.text.split(' ', 1)
     except (ValueError, IndexError): message = "Hey everyone!"
-    chat = await event.get_input_chat(); tagged_users = []
     await event.edit("`Mentioning all users...`")
-    async for user in client.iter_participants(chat):
-        if not user.bot: tagged_users.append(f"• [{user.first_name}](tg://user?id={user.id})")
-    chunk_size = 100
-    for i in range(0, len(tagged_users), chunk_size):
-        chunk = tagged_users[i:i + chunk_size]
-        await client.send_message(event.chat_id, f"{message}\n\n" + "\n".join(chunk))
-    await event.delete()
-@client.on(events.NewMessage(pattern=r'^/(block|unblock)(?:\s|$)', from_users=SUDO_USER))
+    try:
+        members = await PARTICIPANTS.get(event.chat_id, await event.get_input_chat())
+        for text in pack_lines([f"• [{name}](tg://user?id={user_id})" for user_id, name in list(members.items())], message): await send_paced(event.chat_id, text)
+        await event.delete()
+    except FloodWaitError as e:
+        METRICS.inc("flood_waits_total", source="tagall"); await event.edit(f"🚫 Telegram asked to wait {e.seconds}s; stopped mentioning.")
+@command("block", "unblock", access="sudo")
 async def block_unblock_handler(event):
-    if is_on_cooldown(event.sender_id): return
     command = event.pattern_match.group(1)
     if not event.is_reply: return await event.edit(f"Reply to a user to {command} them.")
     reply_msg = await event.get_reply_message()
@@ -478,17 +1990,15 @@ async def block_unblock_handler(event):
         if command == "block": await client(BlockRequest(reply_msg.sender_id)); await event.edit("`User blocked.`")
         elif command == "unblock": await client(UnblockRequest(reply_msg.sender_id)); await event.edit("`User unblocked.`")
     except Exception as e: await event.edit(f"🚫 **Error:** {e}")
-@client.on(events.NewMessage(pattern=r'^/linkgc(?:\s|$)', from_users=SUDO_USER))
+@command("linkgc", access="sudo")
 async def linkgc_handler(event):
-    if is_on_cooldown(event.sender_id): return
     if not event.is_group: return await event.edit("This command can only be used in groups.")
     try:
         link = await client(ExportChatInviteRequest(event.chat_id))
         await event.edit(f"**Group Invite Link:**\n{link.link}")
     except Exception as e: await event.edit(f"🚫 **Error:** {e}\n\nDo I have permission to get the link?")
-@client.on(events.NewMessage(pattern=r'^/(antilink|antidelete|setwelcome)(?:\s|$)', from_users=SUDO_USER))
+@command("antilink", "antidelete", "setwelcome", access="sudo")
 async def chat_settings_handler(event):
-    if is_on_cooldown(event.sender_id): return
     if not event.is_group: return await event.edit("This command only works in groups.")
     parts = event.text.split(); command = event.pattern_match.group(1); chat_id = event.chat_id
     if chat_id not in CHAT_SETTINGS: CHAT_SETTINGS[chat_id] = {}
@@ -504,33 +2014,73 @@ async def chat_settings_handler(event):
                 CHAT_SETTINGS[chat_id]['welcome_enabled'] = False; await event.edit("🚫 Welcome messages have been **disabled**.")
             else: return await event.edit("📋 **Usage:** `/setwelcome <on|off> [message]`")
         except (ValueError, IndexError): return await event.edit("📋 **Usage:** `/setwelcome <on|off> [message]`")
+    elif command == "antilink" and len(parts) > 1 and parts[1].lower() in ("allow", "deny", "remove", "list"):
+        action = parts[1].lower(); settings = CHAT_SETTINGS[chat_id]
+        if action == "list":
+            return await event.edit(f"**🔗 Antilink is {'on' if settings.get('antilink') else 'off'}.**\n"
+                                    f"**Allowed:** `{', '.join(settings.get('link_allow', [])) or 'none'}`\n**Denied:** `{', '.join(settings.get('link_deny', [])) or 'none'}`")
+        if len(parts) < 3: return await event.edit(f"📋 **Usage:** `/antilink {action} <domain|t.me/name> [...]`")
+        rules = {entry: LinkRules.normalize(entry) for entry in parts[2:]}
+        rejected = [entry for entry, rule in rules.items() if rule is None]
+        if rejected: return await event.edit(f"🚫 Paths are only supported for Telegram links. Use the bare domain instead of `{', '.join(rejected)}`.")
+        domains = set(rules.values())
+        for key in ("link_allow", "link_deny"):
+            current = set(settings.get(key, [])) - domains
+            if key == f"link_{action}": current |= domains
+            settings[key] = sorted(current)
+        LINK_FILTER.invalidate(chat_id)
+        await event.edit(f"✅ `{', '.join(sorted(domains))}` {'removed from the link lists' if action == 'remove' else f'added to the {action} list'}.")
     else:
         try:
             _, status = parts
             if status.lower() not in ["on", "off"]: raise ValueError
             is_enabled = status.lower() == "on"; CHAT_SETTINGS[chat_id][command] = is_enabled
+            if command == "antidelete" and not is_enabled: MESSAGE_LOG.clear(chat_id)
             await event.edit(f"✅ `{command}` has been **{'enabled' if is_enabled else 'disabled'}** for this group.")
         except (ValueError, IndexError): return await event.edit(f"📋 **Usage:** `/{command} <on|off>`")
-    save_chat_settings()
-@client.on(events.NewMessage(incoming=True, func=lambda e: e.is_group and not e.out))
+    save_chat_settings(chat_id)
+# Registered before the antilink watcher so links it removes are forgotten again instead of reposted.
+@watcher(lambda e: not e.out and CHAT_SETTINGS.get(e.chat_id, {}).get("antidelete") and not parse_command(e.raw_text))
+async def antidelete_recorder(event): MESSAGE_LOG.record(event.chat_id, event.message)
+@watcher(lambda e: not e.out and e.is_group and CHAT_SETTINGS.get(e.chat_id, {}).get("antilink"))
 async def automatic_moderation_trigger(event):
-    chat_id = event.chat_id; settings = CHAT_SETTINGS.get(chat_id)
-    if not settings: return
-    if settings.get("antilink") and "t.me/" in (event.text or ""):
-        try: await event.delete(); await client.send_message(chat_id, f"🚫 Link removed. `(Sent by {event.sender.first_name})`")
-        except Exception: pass
-    if settings.get("welcome_enabled") and event.user_joined:
-        user = await event.get_user(); chat = await event.get_chat()
-        welcome_msg = settings.get("welcome_msg", "Welcome, {user}!")
-        await event.reply(welcome_msg.format(user=f"[{user.first_name}](tg://user?id={user.id})", chat=chat.title))
+    chat_id = event.chat_id
+    if not LINK_FILTER.check(chat_id, event.message): return
+    MESSAGE_LOG.forget(chat_id, [event.id])
+    try: await event.delete()
+    except Exception: return
+    warn, suppressed = LINK_FILTER.should_warn(chat_id)
+    if not warn: return
+    sender = event.sender or ENTITY_CACHE.peek(event.sender_id)
+    name = getattr(sender, "first_name", None) or getattr(sender, "title", None) or event.sender_id
+    note = f" `(+{suppressed} more removed)`" if suppressed else ""
+    try: await client.send_message(chat_id, f"🚫 Link removed. `(Sent by {name})`{note}")
+    except Exception: pass
+@client.on(events.ChatAction(func=lambda e: (e.user_joined or e.user_added) and CHAT_SETTINGS.get(e.chat_id, {}).get("welcome_enabled")))
+async def welcome_trigger(event):
+    settings = CHAT_SETTINGS[event.chat_id]
+    user = await event.get_user(); chat = await event.get_chat()
+    welcome_msg = settings.get("welcome_msg", "Welcome, {user}!")
+    await event.reply(welcome_msg.format(user=f"[{user.first_name}](tg://user?id={user.id})", chat=chat.title))
+@client.on(events.MessageEdited(func=lambda e: e.chat_id in MESSAGE_LOG.chats))
+async def antidelete_edit_tracker(event): MESSAGE_LOG.update(event.chat_id, event.message)
 @client.on(events.MessageDeleted)
 async def antidelete_trigger(event):
-    if event.chat_id in CHAT_SETTINGS and CHAT_SETTINGS[event.chat_id].get("antidelete"):
-        await client.send_message(event.chat_id, f"🗑️ A message was just deleted.")
-@client.on(events.NewMessage(pattern=r'^/afk(?:\s|$)', from_users=SUDO_USER))
+    restored = MESSAGE_LOG.pop(event.chat_id, event.deleted_ids)
+    if not restored:
+        if event.chat_id in CHAT_SETTINGS and CHAT_SETTINGS[event.chat_id].get("antidelete"): await send_paced(event.chat_id, "🗑️ A message was just deleted.")
+        return
+    for chat_id, entries in restored.items():
+        lines = []
+        for entry in entries:
+            sender = ENTITY_CACHE.peek(entry.sender_id); name = sender.first_name if sender else entry.sender_id
+            if entry.media is None: lines.append(f"• **{name}:** {entry.text[:3500]}"); continue
+            try: await send_paced(chat_id, f"🗑️ **Deleted media from {name}:**\n{entry.text}"[:1024], file=entry.media)
+            except Exception as e: lines.append(f"• **{name}:** [media unavailable: {e}] {entry.text[:3000]}")
+        for text in pack_lines(lines, f"🗑️ **Deleted message{'s' if len(lines) > 1 else ''}:**"): await send_paced(chat_id, text)
+@command("afk", access="sudo")
 async def afk_handler(event):
     global AFK_STATE
-    if is_on_cooldown(event.sender_id): return
     parts = event.text.split(' ', 2); command = parts[1] if len(parts) > 1 else "on"
     if command == "set":
         if len(parts) < 3 or not parts[2].strip(): return await event.edit("📋 Usage: `/afk set <reason>`")
@@ -546,48 +2096,44 @@ async def afk_handler(event):
             await event.edit(f"**Welcome back!** You were AFK for {duration}.")
             AFK_STATE["is_afk"] = False; save_afk_state()
         else: await event.edit("You weren't AFK.")
-@client.on(events.NewMessage(incoming=True, func=lambda e: not e.out))
+@watcher(lambda e: not e.out and AFK_STATE.get("is_afk") and e.sender_id != SUDO_USER)
 async def afk_trigger(event):
-    if not AFK_STATE.get("is_afk") or event.sender_id == SUDO_USER: return
     is_reply = False
     if event.reply_to and event.reply_to.reply_to_peer_id and event.reply_to.reply_to_peer_id.user_id == SUDO_USER: is_reply = True
     if event.is_private or event.mentioned or is_reply:
         duration = get_readable_time(int(time.time()) - AFK_STATE.get("since", 0))
         await event.reply(f"**I'm currently AFK** (for {duration})\nReason: `{AFK_STATE['reason']}`")
 if not BOT_TOKEN:
-    @client.on(events.NewMessage(outgoing=True, from_users=SUDO_USER))
+    @watcher(lambda e: e.out and AFK_STATE.get("is_afk") and e.sender_id == SUDO_USER)
     async def auto_disable_afk(event):
         global AFK_STATE
-        if AFK_STATE.get("is_afk") and not event.text.lower().startswith(('/afk', '/del', '/unpin', '/pin', '/shell')):
+        if not event.text.lower().startswith(('/afk', '/del', '/unpin', '/pin', '/shell')):
             duration = get_readable_time(int(time.time()) - AFK_STATE.get("since", 0))
             AFK_STATE["is_afk"] = False; save_afk_state()
             await client.send_message('me', f"**AFK mode disabled.** You were away for {duration}.")
-@client.on(events.NewMessage(pattern=r'^/(adduser|deluser)(?:\s|$)'))
+@command("adduser", "deluser", access="sudo")
 async def user_admin_handler(event):
-    if event.sender_id != SUDO_USER: return
-    if is_on_cooldown(event.sender_id): return
     command = event.pattern_match.group(1)
     try:
         if event.is_reply: user_id = (await event.get_reply_message()).sender_id
         else: _, user_input = event.text.split(' ', 1); user_id = int(user_input)
         if command == "adduser":
             if user_id in AUTH_USERS: return await event.edit(f"✔️ User `{user_id}` is already authorized.")
-            AUTH_USERS.add(user_id); save_auth_users()
+            AUTH_USERS.add(user_id); save_auth_user(user_id)
             await event.edit(f"👍 User `{user_id}` has been authorized.")
         elif command == "deluser":
             if user_id == SUDO_USER: return await event.edit("🚫 You cannot remove the sudo user.")
             if user_id in AUTH_USERS:
-                AUTH_USERS.remove(user_id); save_auth_users()
+                AUTH_USERS.remove(user_id); save_auth_user(user_id)
                 await event.edit(f"🗑️ User `{user_id}` has been removed from the authorized list.")
             else: await event.edit(f"🤔 User `{user_id}` was not in the authorized list.")
     except (ValueError, IndexError): await event.edit(f"📋 Usage: `/{command} <user_id>` or reply to a user.")
     except Exception as e: await event.edit(f"🚫 Error: {e}")
-@client.on(events.NewMessage(pattern=r'^/(ytmp3|ytmp4|play|fbmp4|ttmp4|igmp4)(?:\s|$)'))
+@command("ytmp3", "ytmp4", "play", "fbmp4", "ttmp4", "igmp4")
 async def media_handler(event):
-    if event.sender_id not in AUTH_USERS: return
-    if is_on_cooldown(event.sender_id): return
-    if event.sender_id in ACTIVE_DOWNLOADS: return await event.reply("⚠️ Please wait for your previous request to complete.")
-    ACTIVE_DOWNLOADS.add(event.sender_id)
+    if sum(ACTIVE_DOWNLOADS.values()) >= MEDIA_QUEUE_LIMIT: return await event.reply("🚦 The media queue is full. Please try again in a bit.")
+    if ACTIVE_DOWNLOADS.get(event.sender_id, 0) >= MEDIA_USER_LIMIT: return await event.reply(f"⚠️ You already have {MEDIA_USER_LIMIT} requests in progress. Please wait for one to complete.")
+    ACTIVE_DOWNLOADS[event.sender_id] = ACTIVE_DOWNLOADS.get(event.sender_id, 0) + 1
     try:
         command_name = f"/{event.pattern_match.group(1)}"
         try: _, query = event.text.split(' ', 1); query = query.strip()
@@ -600,98 +2146,266 @@ async def media_handler(event):
             elif command_name == '/fbmp4': source, file_type, url_regex, error_msg = "facebook", "mp4", FACEBOOK_REGEX, "🚫 Invalid Facebook URL."
             elif command_name == '/ttmp4': source, file_type, url_regex, error_msg = "tiktok", "mp4", TIKTOK_REGEX, "🚫 Invalid TikTok URL."
             elif command_name == '/igmp4': source, file_type, url_regex, error_msg = "instagram", "mp4", INSTAGRAM_REGEX, "🚫 Invalid Instagram URL."
-            if not re.match(url_regex, query): return await status_msg.edit(error_msg)
-            await status_msg.edit("⏳ **Processing URL...**")
+            if not re.match(url_regex, query): return await STATUS_EDITOR.edit(status_msg, error_msg)
+            await STATUS_EDITOR.edit(status_msg, "⏳ **Processing URL...**", wait=False)
             await handle_download_request(event, query, file_type, status_msg, source)
-    finally: ACTIVE_DOWNLOADS.remove(event.sender_id)
+    finally:
+        ACTIVE_DOWNLOADS[event.sender_id] -= 1
+        if not ACTIVE_DOWNLOADS[event.sender_id]: del ACTIVE_DOWNLOADS[event.sender_id]
 async def handle_play_command(event, query, status_msg):
+    list_mode = query.startswith("-l ")
+    if list_mode: query = query[3:].strip()
     try:
-        await status_msg.edit(f"🔎 **Searching for:** `{query}`")
-        ydl_opts = {'quiet': True, 'skip_download': True, 'extract_flat': 'in_playlist', 'default_search': 'ytsearch1'}
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl: info = await run_sync_in_executor(lambda: ydl.extract_info(query, download=False))
-        if not info.get("entries"): return await status_msg.edit("🚫 No search results found.")
-        first_result = info['entries'][0]
-        video_url = first_result.get('webpage_url') or f"https://www.youtube.com/watch?v={first_result['id']}"
-        title = first_result.get('title', 'Unknown Title')
-        await status_msg.edit(f"✅ **Found:** `{title}`\n\nNow processing...")
-        await handle_download_request(event, video_url, "mp3", status_msg, "youtube")
+        results = SEARCH_BACKEND.cached(query)
+        if results is None:
+            await STATUS_EDITOR.edit(status_msg, f"🔎 **Searching for:** `{query}`", wait=False)
+            async def on_position(position: int): await STATUS_EDITOR.edit(status_msg, f"🕒 Queued for search, position `{position}`...", wait=False)
+            async with MEDIA_STAGES["resolve"].slot(event.sender_id, on_position): results = await SEARCH_BACKEND.search(query, PLAY_MAX_RESULTS)
+        if not results: return await STATUS_EDITOR.edit(status_msg, "🚫 No search results found.")
+        if list_mode:
+            lines = [f"{i}. [{r['title']}]({r['url']})" + (f" `{int(r['duration']) // 60}:{int(r['duration']) % 60:02d}`" if r.get('duration') else "") for i, r in enumerate(results, 1)]
+            return await STATUS_EDITOR.edit(status_msg, f"🔎 **Top results for:** `{query}`\n\n" + "\n".join(lines) + "\n\nUse `/ytmp3 <url>` to get one.", link_preview=False)
+        first_result = results[0]
+        await STATUS_EDITOR.edit(status_msg, f"✅ **Found:** `{first_result['title']}`\n\nNow processing...", wait=False)
+        await handle_download_request(event, first_result['url'], "mp3", status_msg, "youtube")
     except Exception as e:
-        await status_msg.edit(f"🚫 Search Error: {e}"); print(f"Error in /play command search: {e}")
+        await STATUS_EDITOR.edit(status_msg, f"🚫 Search Error: {e}"); print(f"Error in /play command search: {e}")
+class MediaJob:
+    """An in-flight media request. Later requests for the same media key attach their status messages to it."""
+    def __init__(self, key: str, chat_id: int, user_id: int):
+        self.key = key; self.user_id = user_id; self.status_msgs = []; self.delivered_chats = {chat_id}
+        self.done = asyncio.get_running_loop().create_future()
+    def queued(self, stage: str):
+        async def on_position(position: int): await self.edit(f"🕒 Queued for {stage}, position `{position}`...")
+        return on_position
+    async def edit(self, text: str):
+        for msg in self.status_msgs: await STATUS_EDITOR.edit(msg, text, wait=False)
+async def cache_thumbnail(cache_name: str, thumb_url: str) -> str | None:
+    """Fetches the API thumbnail once, normalizes it in a media worker and keeps it next to the cached file."""
+    try:
+        async with get_http_session().get(thumb_url, timeout=aiohttp.ClientTimeout(total=HTTP_API_TIMEOUT)) as response:
+            if response.status != 200 or (response.content_length or 0) > THUMBNAIL_MAX_BYTES: return None
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data += chunk
+                if len(data) > THUMBNAIL_MAX_BYTES: return None
+        return MEDIA_CACHE.store_thumbnail(cache_name, await run_media_task(make_thumbnail, bytes(data)))
+    except Exception as e: print(f"⚠️ Could not cache thumbnail for {cache_name}: {e}"); return None
 async def handle_download_request(event, url: str, file_type: str, status_msg, source: str):
+    api_endpoint_map = {"youtube": "youtube/videofhd" if file_type == "mp4" else "youtube/audio", "facebook": "facebook/video", "tiktok": "tiktok/video", "instagram": "instagram/video"}
+    api_endpoint = api_endpoint_map.get(source)
+    if not api_endpoint: return await STATUS_EDITOR.edit(status_msg, "🚫 Unknown download source.")
+    cache_key = get_media_key(source, url, api_endpoint.split('/')[-1])
+    job = IN_FLIGHT_MEDIA.get(cache_key)
+    if job:
+        job.status_msgs.append(status_msg)
+        await STATUS_EDITOR.edit(status_msg, "⏳ Someone else requested this too, joining their download...", wait=False)
+        if not await asyncio.shield(job.done): return
+        if event.chat_id not in job.delivered_chats:
+            job.delivered_chats.add(event.chat_id)
+            if not await send_by_reference(event.chat_id, cache_key): return await STATUS_EDITOR.edit(status_msg, "🚫 Could not send the shared upload here.")
+    else:
+        job = MediaJob(cache_key, event.chat_id, event.sender_id); job.status_msgs.append(status_msg); IN_FLIGHT_MEDIA[cache_key] = job
+        sent = False
+        try: sent = await process_media_job(job, url, file_type, source, api_endpoint, event.chat_id)
+        finally: IN_FLIGHT_MEDIA.pop(cache_key, None); job.done.set_result(sent)
+        if not sent: return
+    await STATUS_EDITOR.edit(status_msg, "✅ Done!"); await asyncio.sleep(1)
+    STATUS_EDITOR.discard(status_msg); await status_msg.delete()
+async def process_media_job(job: MediaJob, url: str, file_type: str, source: str, api_endpoint: str, chat_id: int) -> bool:
+    """Resolves, downloads and uploads one media item to `chat_id`. Progress and errors go to every attached status message."""
+    pinned_name = None; cache_key = job.key
     try:
-        cache_key = hashlib.md5(url.encode()).hexdigest(); ext = f".{file_type}"
-        cached_file_path = os.path.join(CACHE_DIRECTORY, f"{cache_key}{ext}")
-        is_cached = os.path.exists(cached_file_path)
-        api_endpoint_map = {"youtube": "youtube/videofhd" if file_type == "mp4" else "youtube/audio", "facebook": "facebook/video", "tiktok": "tiktok/video", "instagram": "instagram/video"}
-        api_endpoint = api_endpoint_map.get(source)
-        if not api_endpoint: return await status_msg.edit("🚫 Unknown download source.")
-        api_url = f"{API_BASE_URL}/{api_endpoint}?url={url}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(api_url) as response:
-                if response.status != 200: return await status_msg.edit(f"🚫 API Error: Server responded with status `{response.status}`.")
-                data = await response.json()
-        if not data.get("success"): return await status_msg.edit("🚫 API Error: Could not process the URL.")
-        result = data.get("result", {}); title = result.get("title", "media"); quality = result.get("quality", "Unknown")
-        download_url = result.get("download_url"); thumb_url = result.get("thumbnail")
-        if not is_cached:
-            if not download_url: return await status_msg.edit("🚫 API Error: Could not find a download URL.")
-            await status_msg.edit(f"📥 Downloading `{title}`...")
-            if not await download_file(download_url, cached_file_path): return await status_msg.edit("🚫 Download failed.")
-        else: await status_msg.edit("✅ Using cached file. Preparing to upload...")
-        file_size = os.path.getsize(cached_file_path)
-        if file_size > MAX_FILE_SIZE:
-            os.remove(cached_file_path); return await status_msg.edit(f"🚫 File too large: {human_readable_size(file_size)} "
-                                       f"(limit: {human_readable_size(MAX_FILE_SIZE)}).\n"
-                                       f"🗑️ Removed from cache.")
+        ext = f".{file_type}"; cache_name = f"{cache_key}{ext}"
+        if await send_by_reference(chat_id, cache_key): METRICS.inc("media_requests_total", result="file_ref"); return True
+        stored_ref = FILE_REFS.get(cache_key, {})
+        cached_file_path = MEDIA_CACHE.lookup(cache_name)
+        is_cached = cached_file_path is not None; meta = MEDIA_CACHE.meta(cache_name) if is_cached else {}
+        # Pin before the first await, so another job's commit or eviction cannot delete the hit while we resolve it.
+        if is_cached: MEDIA_CACHE.pin(cache_name); pinned_name = cache_name
+        METRICS.inc("media_requests_total", result="cache" if is_cached else "download")
+        if "title" in meta:
+            # The sidecar already has everything the API would tell us, so a warm request makes no API call at all.
+            title = meta["title"]; quality = meta["quality"]; download_url = None; thumb_url = stored_ref.get("thumb_url")
+        else:
+            api_url = f"{API_BASE_URL}/{api_endpoint}?url={url}"
+            async with MEDIA_STAGES["resolve"].slot(job.user_id, job.queued("processing")), METRICS.timer("media_stage_seconds", stage="resolve"):
+                async with get_http_session().get(api_url, timeout=aiohttp.ClientTimeout(total=HTTP_API_TIMEOUT)) as response:
+                    if response.status != 200: return await job.edit(f"🚫 API Error: Server responded with status `{response.status}`.")
+                    data = await response.json()
+            if not data.get("success"): return await job.edit("🚫 API Error: Could not process the URL.")
+            result = data.get("result", {}); title = result.get("title", "media"); quality = result.get("quality", "Unknown")
+            download_url = result.get("download_url"); thumb_url = result.get("thumbnail") or stored_ref.get("thumb_url")
+        full_title = title
         base_caption = f"**Title:** \n**Quality:** `{quality}`"; available_space = 1024 - len(base_caption) - 4
         if len(title) > available_space: title = title[:available_space - 3] + "..."
         caption_text = f"**Title:** `{title}`\n**Quality:** `{quality}`"
-        upload_start_time = time.monotonic(); last_edit_time = 0
+        upload_start_time = time.monotonic()
         async def progress_callback(current, total):
-            nonlocal last_edit_time; current_time = time.monotonic()
-            if current_time - last_edit_time < 2: return
-            last_edit_time = current_time; percent = (current / total) * 100
+            # Called for every uploaded part; STATUS_EDITOR keeps only the latest text, so no throttle is needed here.
+            current_time = time.monotonic(); percent = (current / total) * 100
             elapsed_time = current_time - upload_start_time
             speed = current / elapsed_time if elapsed_time > 0 else 0
             progress_bar = "".join(["▰" if i < percent / 10 else "▱" for i in range(10)])
-            try:
-                await status_msg.edit(f"📤 **Uploading:** `{title}`\n"
-                                      f"`[{progress_bar}] {percent:.1f}%`\n"
-                                      f"`{human_readable_size(current)} / {human_readable_size(total)}`\n"
-                                      f"**Speed:** `{human_readable_size(speed)}/s`")
-            except Exception: pass
-        await status_msg.edit(f"📤 Uploading `{title}`...")
-        media_meta = get_media_metadata(cached_file_path)
-        duration = int(media_meta.get('duration', 0)); width = media_meta.get('width', 0); height = media_meta.get('height', 0)
-        thumb_path = None
-        if thumb_url: thumb_path = await download_file(thumb_url, os.path.join(CACHE_DIRECTORY, f"thumb_{cache_key}.jpg"))
+            await job.edit(f"📤 **Uploading:** `{title}`\n"
+                           f"`[{progress_bar}] {percent:.1f}%`\n"
+                           f"`{human_readable_size(current)} / {human_readable_size(total)}`\n"
+                           f"**Speed:** `{human_readable_size(speed)}/s`")
+        uploaded_file = None; media_meta = None
+        if not is_cached:
+            if not download_url: return await job.edit("🚫 API Error: Could not find a download URL.")
+            tmp_path = MEDIA_CACHE.temp_path(cache_name)
+            async def fetch(progress: DownloadProgress | None):
+                async with MEDIA_STAGES["download"].slot(job.user_id, job.queued("download")):
+                    await wait_for_download_capacity(job.edit)
+                    await job.edit(f"📥 Downloading `{title}`...")
+                    with METRICS.timer("media_stage_seconds", stage="download"): return await download_file(download_url, tmp_path, progress)
+            if STREAM_UPLOAD:
+                # Pipelined mode: upload parts go out as soon as the matching bytes are on disk. The `.part` file
+                # is the buffer between the two stages, so memory stays flat and the cache is still filled.
+                progress = DownloadProgress(); download = asyncio.ensure_future(fetch(progress))
+                ready = asyncio.ensure_future(progress.ready.wait())
+                await asyncio.wait([download, ready], return_when=asyncio.FIRST_COMPLETED); ready.cancel()
+                if not download.done() and progress.total:
+                    if progress.total > MAX_FILE_SIZE:
+                        download.cancel(); return await job.edit(f"🚫 File too large: {human_readable_size(progress.total)} "
+                                                               f"(limit: {human_readable_size(MAX_FILE_SIZE)}).")
+                    probe = asyncio.ensure_future(probe_prefix_metadata(progress)) if file_type == "mp4" else None
+                    reader = StreamingReader(progress, f"{title}{ext}")
+                    try:
+                        async with MEDIA_STAGES["upload"].slot(job.user_id, job.queued("upload")), METRICS.timer("media_stage_seconds", stage="upload"):
+                            upload_start_time = time.monotonic()
+                            uploaded_file = await upload_file_parallel(reader, file_size=progress.total, file_name=f"{title}{ext}", progress_callback=progress_callback)
+                    except BaseException:
+                        download.cancel()
+                        if probe: probe.cancel()
+                        raise
+                    finally: reader.close()
+                    if probe:
+                        try: media_meta = await probe
+                        except Exception as e: print(f"⚠️ Could not probe metadata while streaming: {e}")
+                downloaded = await download
+            else: downloaded = await fetch(None)
+            if not downloaded:
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+                return await job.edit("🚫 Download failed.")
+            file_size = os.path.getsize(tmp_path)
+            if file_size > MAX_FILE_SIZE:
+                os.remove(tmp_path); return await job.edit(f"🚫 File too large: {human_readable_size(file_size)} "
+                                           f"(limit: {human_readable_size(MAX_FILE_SIZE)}).")
+            cached_file_path = MEDIA_CACHE.commit(cache_name, tmp_path, source); MEDIA_CACHE.pin(cache_name); pinned_name = cache_name
+        else:
+            await job.edit("✅ Using cached file. Preparing to upload...")
+            file_size = os.path.getsize(cached_file_path)
+            if file_size > MAX_FILE_SIZE:
+                MEDIA_CACHE.remove(cache_name); return await job.edit(f"🚫 File too large: {human_readable_size(file_size)} "
+                                                          f"(limit: {human_readable_size(MAX_FILE_SIZE)}).\n"
+                                                          f"🗑️ Removed from cache.")
+        if not uploaded_file: await job.edit(f"📤 Uploading `{title}`...")
+        if "duration" not in meta:
+            if not media_meta or not media_meta.get('duration'): media_meta = await run_media_task(get_media_metadata, cached_file_path)
+            meta = {"duration": int(media_meta.get('duration', 0)), "width": media_meta.get('width', 0), "height": media_meta.get('height', 0),
+                    "title": full_title, "quality": quality}
+            MEDIA_CACHE.set_meta(cache_name, **meta)
+        # The stored thumbnail also stands in when the API stops returning one for this media.
+        thumb_path = MEDIA_CACHE.thumbnail(cache_name)
+        if not thumb_path and thumb_url: thumb_path = await cache_thumbnail(cache_name, thumb_url)
         attrs = [DocumentAttributeFilename(file_name=f"{title}{ext}")]
-        if file_type == "mp3": attrs.append(DocumentAttributeAudio(duration=duration, title=title, performer=source.capitalize()))
-        else: attrs.append(DocumentAttributeVideo(duration=duration, w=width, h=height, supports_streaming=True))
-        await client.send_file(event.chat_id, cached_file_path, caption=caption_text, thumb=thumb_path, attributes=attrs, progress_callback=progress_callback)
-        await status_msg.edit("✅ Done!"); await asyncio.sleep(1); await status_msg.delete()
-        if thumb_path and os.path.exists(thumb_path): os.remove(thumb_path)
+        if file_type == "mp3": attrs.append(DocumentAttributeAudio(duration=meta["duration"], title=title, performer=source.capitalize()))
+        else: attrs.append(DocumentAttributeVideo(duration=meta["duration"], w=meta["width"], h=meta["height"], supports_streaming=True))
+        if not uploaded_file:
+            async with MEDIA_STAGES["upload"].slot(job.user_id, job.queued("upload")), METRICS.timer("media_stage_seconds", stage="upload"):
+                upload_start_time = time.monotonic()
+                uploaded_file = await upload_file_parallel(cached_file_path, file_name=f"{title}{ext}", progress_callback=progress_callback)
+        sent = await client.send_file(chat_id, uploaded_file, caption=caption_text, thumb=thumb_path, attributes=attrs)
+        remember_file_ref(cache_key, sent, caption_text, thumb_url)
+        return True
+    except InsufficientDiskError as e:
+        await job.edit(f"🚫 {e}"); print(f"⚠️ {e}")
+        return False
     except Exception as e:
-        await status_msg.edit(f"🚫 An unexpected error occurred: {e}"); print(f"Error in handle_download_request: {e}")
-@client.on(events.NewMessage(pattern=r'^/shell (.+)', from_users=SUDO_USER))
+        await job.edit(f"🚫 An unexpected error occurred: {e}"); print(f"Error in process_media_job: {e}")
+        return False
+    finally:
+        if pinned_name: MEDIA_CACHE.unpin(pinned_name)
+@command("shell", access="sudo")
 async def shell_prepare(event):
-    if is_on_cooldown(event.sender_id): return
-    command = event.pattern_match.group(1); PENDING_SHELL_COMMANDS[event.chat_id] = command
+    try: _, command = event.raw_text.split(' ', 1); command = command.strip()
+    except (ValueError, IndexError): return await event.reply("📋 Usage: `/shell <command>`")
+    if not command: return await event.reply("📋 Usage: `/shell <command>`")
+    PENDING_SHELL_COMMANDS[event.chat_id] = command
     await event.reply(f"⚠️ **Confirm Execution?**\n\n💻 `{command}`\n\nReply with `/confirm` or `/cancel` to this message.")
-@client.on(events.NewMessage(pattern=r'^/confirm$', from_users=SUDO_USER, func=lambda e: e.is_reply))
+class ShellJob:
+    """A running /shell command. Output is spooled (memory first, then a temp file) and only a tail is kept for edits."""
+    def __init__(self, job_id: int, command: str, chat_id: int):
+        self.id = job_id; self.command = command; self.chat_id = chat_id; self.process = None; self.status_msg = None
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SHELL_SPOOL_MEMORY); self.size = 0; self.truncated = False
+        self.tail = b""; self.cancelled = False; self.timed_out = False
+    def write(self, data: bytes):
+        self.tail = (self.tail + data)[-SHELL_PREVIEW_CHARS:]
+        if self.size + len(data) > SHELL_MAX_OUTPUT: data = data[:max(0, SHELL_MAX_OUTPUT - self.size)]; self.truncated = True
+        self.spool.write(data); self.size += len(data)
+    def preview(self) -> str:
+        return self.tail.decode(errors="replace").strip()
+    async def read(self, size: int) -> bytes:
+        """Reads the spooled output in a thread (it may be a large temp file), so the job can be passed to upload_file_parallel."""
+        return await asyncio.to_thread(self.spool.read, size)
+    def kill(self):
+        if self.process and self.process.returncode is None:
+            try: os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError: pass
+async def run_shell_job(job: ShellJob):
+    """Runs the command without blocking the loop, editing the status message with the latest output as it arrives."""
+    job.process = await asyncio.create_subprocess_shell(job.command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                                                        stdin=asyncio.subprocess.DEVNULL, start_new_session=True)
+    async def read_output():
+        while chunk := await job.process.stdout.read(64 * 1024): job.write(chunk)
+        await job.process.wait()
+    async def show_progress():
+        while True:
+            await asyncio.sleep(SHELL_EDIT_INTERVAL)
+            await STATUS_EDITOR.edit(job.status_msg, f"⏳ **Job #{job.id}** `{job.command}`\n```\n{job.preview() or '...'}\n```", wait=False)
+    ticker = spawn(show_progress())
+    try: await asyncio.wait_for(read_output(), SHELL_TIMEOUT)
+    except asyncio.TimeoutError: job.timed_out = True; job.kill(); await job.process.wait()
+    finally: ticker.cancel()
+async def finish_shell_job(job: ShellJob):
+    code = job.process.returncode if job.process else None
+    if job.cancelled: status = f"❌ Job #{job.id} was cancelled."
+    elif job.timed_out: status = f"⏱️ Job #{job.id} timed out after {SHELL_TIMEOUT} seconds."
+    else: status = f"{'✅' if code == 0 else '⚠️'} Job #{job.id} exited with code `{code}`."
+    if job.truncated: status += f"\n✂️ Output truncated at {human_readable_size(SHELL_MAX_OUTPUT)}."
+    full_output = f"$ {job.command}\n\n{job.preview() or 'No output.'}"
+    if job.size <= SHELL_PREVIEW_CHARS: await STATUS_EDITOR.edit(job.status_msg, f"```\n{full_output}\n```\n{status}")
+    else:
+        job.spool.seek(0)
+        output_file = await upload_file_parallel(job, file_size=job.size, file_name="shell_output.txt")
+        await client.send_file(job.chat_id, output_file, caption=f"💻 Shell Output (too long)\n{status}", reply_to=job.status_msg.id,
+                               attributes=[DocumentAttributeFilename(file_name="shell_output.txt")], force_document=True)
+        await STATUS_EDITOR.edit(job.status_msg, f"```\n{full_output}\n```\n{status}")
+@command("confirm", access="sudo")
 async def shell_confirm(event):
-    if is_on_cooldown(event.sender_id): return
+    if not event.is_reply: return
     if event.chat_id not in PENDING_SHELL_COMMANDS: return await event.reply("ℹ️ No pending command in this chat to confirm.")
-    command = PENDING_SHELL_COMMANDS.pop(event.chat_id); await event.reply(f"🚀 Executing `{command}`...")
-    output = run_shell_command(command); full_output = f"$ {command}\n\n{output or 'No output.'}"
-    if len(full_output) > 4000:
-        with BytesIO(full_output.encode()) as f:
-            f.name = "shell_output.txt"
-            await event.client.send_file(event.chat_id, f, caption="💻 Shell Output (too long)")
-    else: await event.reply(f"```\n{full_output.strip()}\n```")
-@client.on(events.NewMessage(pattern=r'^/cancel$', from_users=SUDO_USER, func=lambda e: e.is_reply))
+    command = PENDING_SHELL_COMMANDS.pop(event.chat_id)
+    job = ShellJob(next(SHELL_JOB_IDS), command, event.chat_id); RUNNING_SHELL_JOBS[job.id] = job
+    try:
+        job.status_msg = await event.reply(f"🚀 Executing `{command}` as **job #{job.id}**...\nReply `/cancel` here or send `/cancel {job.id}` to stop it.")
+        await run_shell_job(job); await finish_shell_job(job)
+    except Exception as e: await event.reply(f"🚫 Execution error: {e}")
+    finally:
+        RUNNING_SHELL_JOBS.pop(job.id, None); job.kill(); job.spool.close()
+@command("cancel", access="sudo", cooldown=False)
 async def shell_cancel(event):
-    if is_on_cooldown(event.sender_id): return
+    parts = event.raw_text.split()
+    if len(parts) > 1:
+        job = RUNNING_SHELL_JOBS.get(int(parts[1].lstrip('#'))) if parts[1].lstrip('#').isdigit() else None
+        if not job: return await event.reply(f"ℹ️ No running shell job `{parts[1]}`.")
+    elif not event.is_reply: return
+    else: job = next((j for j in RUNNING_SHELL_JOBS.values() if j.chat_id == event.chat_id and j.status_msg and j.status_msg.id == event.reply_to_msg_id), None)
+    if job:
+        job.cancelled = True; job.kill()
+        return await event.reply(f"🛑 Stopping job #{job.id}...")
     if event.chat_id in PENDING_SHELL_COMMANDS:
         command = PENDING_SHELL_COMMANDS.pop(event.chat_id)
         await event.reply(f"❌ Cancelled execution of `{command}`.")
@@ -700,9 +2414,12 @@ async def shell_cancel(event):
 async def main():
     """Initializes and runs the user bot, handling graceful shutdown."""
     global MAX_FILE_SIZE
+    STARTUP["load"] = time.monotonic() - BOOT_TIME
     if not os.path.isdir(CACHE_DIRECTORY): os.makedirs(CACHE_DIRECTORY)
-    load_persistent_data()
-    print("🚀 Bot is starting...")
+    stage_start = time.monotonic()
+    await load_persistent_data(); await load_file_refs(); await ENTITY_CACHE.load(); MEDIA_CACHE.load()
+    STARTUP["state"] = time.monotonic() - stage_start; count_telethon_flood_waits()
+    print("🚀 Bot is starting..."); stage_start = time.monotonic()
     try:
         if BOT_TOKEN:
             print("Starting in Bot Mode..."); await client.start(bot_token=BOT_TOKEN)
@@ -710,17 +2427,29 @@ async def main():
             print("Starting in User Bot Mode..."); await client.start()
     except Exception as e:
         print(f"🚫 Failed to start client: {e}"); return
+    STARTUP["connect"] = time.monotonic() - stage_start
     me = await client.get_me()
     if getattr(me, "premium", False):
         MAX_FILE_SIZE = 4 * 1024 * 1024 * 1024; print("🌟 Premium account detected. Max file size set to 4GB.")
     else: print("📦 Standard account. Max file size set to 2GB.")
     loop = asyncio.get_running_loop()
     for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, STOP_EVENT.set)
+    spawn(monitor_loop_lag())
+    try: metrics_runner = await start_metrics_server()
+    except OSError as e: metrics_runner = None; print(f"⚠️ Could not start the metrics endpoint: {e}")
+    STARTUP["ready"] = time.monotonic() - BOOT_TIME
+    print(f"⏱️ Ready in {STARTUP['ready']:.2f}s (module load {STARTUP['load']:.2f}s, state {STARTUP['state']:.2f}s, "
+          f"connect {STARTUP['connect']:.2f}s), RSS {peak_rss_mb():.0f} MiB.")
+    SEARCH_BACKEND.warm()  # Only submits work to the search threads, which import yt-dlp there rather than on the loop.
+    if PREWARM: spawn(prewarm_dependencies())
     print(f"✅ Bot has started successfully. Sudo user is {SUDO_USER}.")
     print("👂 Listening for all commands and events... Press Ctrl+C to stop.")
     try: await STOP_EVENT.wait()
     finally:
         print("\n🛑 Shutdown signal received.")
+        if metrics_runner: await metrics_runner.cleanup()
+        await close_http_session(); await STATE_STORE.close(); shutdown_media_pool(); SEARCH_BACKEND.close(); SPEECH.close()
+        if MEDIA_CACHE.dirty: MEDIA_CACHE.save()
         if client.is_connected():
             print("🔌 Disconnecting client and shutting down gracefully...")
             await client.disconnect()
@@ -0,0 +1,74 @@
+"""
+Microbenchmark: messages/second through command dispatch.
+
+"legacy" replays the old layout, where every command had its own `events.NewMessage(pattern=...)` handler and each
+message was matched against all of them, plus the two catch-all triggers. "dispatcher" runs `app.dispatch_message`.
+
+    python bench/bench_dispatch.py [--messages 200000] [--command-ratio 0.05]
+"""
+import re
+import time
+import random
+import asyncio
+import argparse
+
+from harness import app
+
+# The patterns the old per-command handlers were registered with, in registration order.
+LEGACY_PATTERNS = [r'^/listusers(?:\s|$)', r'^/menu(?:\s|$)', r'^/menuadmin(?:\s|$)', r'^/ping(?:\s|$)', r'^/uptime(?:\s|$)',
+                   r'^/info(?:\s|$)', r'^/pp(?:\s|$)', r'^/vv(?:\s|$)', r'^/sticker(?:\s|$)', r'^/toimage(?:\s|$)',
+                   r'^/tovnote(?:\s|$)', r'^/gpt(?:\s|$)', r'^/pickup(?:\s|$)', r'^/(ban|unban|mute|unmute|kick|promote|demote)(?:\s|$)',
+                   r'^/(pin|unpin)(?:\s|$)', r'^/del(?:\s|$)', r'^/tagall(?:\s|$)', r'^/(block|unblock)(?:\s|$)', r'^/linkgc(?:\s|$)',
+                   r'^/(antilink|antidelete|setwelcome)(?:\s|$)', r'^/afk(?:\s|$)', r'^/(adduser|deluser)(?:\s|$)',
+                   r'^/(ytmp3|ytmp4|play|fbmp4|ttmp4|igmp4)(?:\s|$)', r'^/shell (.+)', r'^/confirm$', r'^/cancel$']
+
+class FakeEvent:
+    # Slimmer than harness.FakeEvent on purpose: this measures dispatch overhead, not attribute lookups.
+    __slots__ = ("raw_text", "text", "sender", "sender_id", "chat_id", "out", "is_group", "pattern_match")
+    def __init__(self, text: str, sender_id: int, chat_id: int):
+        self.raw_text = self.text = text; self.sender = None; self.sender_id = sender_id; self.chat_id = chat_id
+        self.out = False; self.is_group = True; self.pattern_match = None
+
+def make_stream(count: int, command_ratio: float) -> list:
+    rng = random.Random(42); commands = list(app.COMMANDS)
+    chatter = ["lol", "anyone here?", "good morning everyone", "check this out https://example.com", "ok", "🔥🔥🔥"]
+    # Commands come from non-authorized group members, so both paths stop at the auth check and no handler body runs.
+    return [FakeEvent(f"/{rng.choice(commands)} something" if rng.random() < command_ratio else rng.choice(chatter),
+                      rng.randint(10_000, 99_999), -100123) for _ in range(count)]
+
+async def run_legacy(stream: list) -> float:
+    compiled = [re.compile(p).match for p in LEGACY_PATTERNS]
+    async def command_handler(event):
+        if event.sender_id not in app.AUTH_USERS: return
+    async def moderation_trigger(event):
+        if not app.CHAT_SETTINGS.get(event.chat_id): return
+    async def afk_trigger(event):
+        if not app.AFK_STATE.get("is_afk") or event.sender_id == app.SUDO_USER: return
+    start = time.perf_counter()
+    for event in stream:
+        for match in compiled:
+            m = match(event.raw_text)
+            if m: event.pattern_match = m; await command_handler(event)
+        if event.is_group and not event.out: await moderation_trigger(event)
+        if not event.out: await afk_trigger(event)
+    return time.perf_counter() - start
+
+async def run_dispatcher(stream: list) -> float:
+    start = time.perf_counter()
+    for event in stream: await app.dispatch_message(event)
+    return time.perf_counter() - start
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--command-ratio", type=float, default=0.05)
+    args = parser.parse_args()
+    app.AUTH_USERS.clear(); app.AUTH_USERS.add(app.SUDO_USER)
+    stream = make_stream(args.messages, args.command_ratio)
+    print(f"{args.messages} messages, {args.command_ratio:.0%} commands, {len(app.COMMANDS)} registered commands")
+    for name, runner in (("legacy", run_legacy), ("dispatcher", run_dispatcher)):
+        elapsed = await runner(stream)
+        print(f"  {name:<11} {args.messages / elapsed:>12,.0f} msg/s  ({elapsed * 1e6 / args.messages:.2f} µs/msg)")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,160 @@
+"""
+Load scenarios for the bot's hot paths, run entirely offline against `harness.FakeClient` and `harness.FakeDownloadAPI`.
+
+    chatter  group chatter (links, mentions, stray commands, batched deletions) through dispatch, antilink, antidelete and AFK
+    burst    concurrent /ytmp4 requests through resolve, download, cache, upload and send, with duplicate URLs mixed in
+    tagall   /tagall on a large group, cold (participant fetch) and warm (participant cache)
+    gpt      concurrent streamed /gpt prompts against a mock SSE server, with repeated prompts served from the cache,
+             followed by correctness checks (final text, cache hit, HTTP error, stream cut mid-answer)
+
+Each scenario prints throughput, p50/p99 latency and the process's peak RSS so far.
+
+    python bench/bench_scenarios.py [chatter|burst|tagall|all] [--messages 50000] [--requests 24] [--members 20000] ...
+"""
+import random
+import asyncio
+import argparse
+import time
+import itertools
+
+from harness import app, FakeClient, FakeUser, FakeMessage, FakeEvent, FakeDeletedEvent, FakeDownloadAPI, FakeCompletionAPI, install, uninstall, report
+
+async def scenario_chatter(args):
+    rng = random.Random(1); client = FakeClient(rtt=args.rtt); await install(client)
+    app.TAGALL_RATE = 1e6; app.TAGALL_BURST = 1000; app.SEND_BUCKETS.clear()
+    chats = [-1001000000000 - i for i in range(args.chats)]
+    deny = [f"spam{i}.example" for i in range(args.rules)]; allow = [f"ok{i}.example" for i in range(args.rules // 4)]
+    for chat_id in chats:
+        app.CHAT_SETTINGS[chat_id] = {"antilink": True, "antidelete": True, "link_deny": deny, "link_allow": allow}; app.LINK_FILTER.invalidate(chat_id)
+    app.AFK_STATE.update({"is_afk": True, "reason": "benchmarking", "since": int(time.time())})
+    senders = list(range(1000, 1000 + args.users)); client.users.update({uid: FakeUser(uid) for uid in senders})
+    chatter = ["lol", "anyone here?", "good morning everyone", "check https://docs.python.org/3/ out", "ok 👍", "🔥🔥🔥",
+               "meeting moved to 5pm, see www.ok3.example/agenda", "what do you think about this long message " * 4]
+    events = []; recent = {chat_id: [] for chat_id in chats}
+    for i in range(args.messages):
+        chat_id = rng.choice(chats); roll = rng.random()
+        if roll < 0.03: text = f"join t.me/+{rng.randrange(10**8):x}"
+        elif roll < 0.06: text = f"cheap stuff at https://spam{rng.randrange(args.rules)}.example/deal"
+        elif roll < 0.09: text = f"/{rng.choice(list(app.COMMANDS))} something"
+        else: text = rng.choice(chatter)
+        message = FakeMessage(client, chat_id, rng.choice(senders), text, mentioned=rng.random() < 0.01)
+        events.append(FakeEvent(message)); recent[chat_id].append(message.id)
+        if i % 50 == 49:
+            ids = recent[chat_id][-10:]; rng.shuffle(ids); events.append(FakeDeletedEvent(chat_id, ids[:5]))
+    latencies = []; deletions = 0
+    start = time.perf_counter()
+    for event in events:
+        t = time.perf_counter()
+        if isinstance(event, FakeDeletedEvent): await app.antidelete_trigger(event); deletions += 1
+        else: await app.dispatch_message(event)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    report("chatter", len(events), elapsed, latencies, "events",
+           f"\n             {deletions} deletion batches, {client.calls['delete_messages']} links removed, {client.sent} messages sent, "
+           f"{app.MESSAGE_LOG.total_bytes / 1024:.0f} KiB message log")
+    app.AFK_STATE["is_afk"] = False; await uninstall()
+
+async def scenario_burst(args):
+    client = FakeClient(rtt=args.rtt, link_bytes_per_sec=args.link_mbps * 1e6 / 8); await install(client)
+    api = FakeDownloadAPI(args.size_mb * 1024 * 1024, api_latency=args.api_latency, bandwidth=args.download_mbps * 1e6 / 8)
+    app.API_BASE_URL = await api.start()
+    app.MEDIA_QUEUE_LIMIT = max(app.MEDIA_QUEUE_LIMIT, args.requests)
+    rng = random.Random(2); unique = max(1, int(args.requests * (1 - args.duplicates)))
+    video_ids = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789_-") for _ in range(11)) for _ in range(unique)]
+    requests = []
+    for i in range(args.requests):
+        user_id = 5000 + i; app.AUTH_USERS.add(user_id)
+        requests.append(FakeEvent(FakeMessage(client, -1002000000000 - (i % 4), user_id, f"/ytmp4 https://youtu.be/{video_ids[i % unique]}")))
+    latencies = []
+    async def run(message):
+        t = time.perf_counter(); await app.dispatch_message(message); latencies.append(time.perf_counter() - t)
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(run(message) for message in requests))
+        elapsed = time.perf_counter() - start
+    finally:
+        await uninstall(); await api.stop()
+    mib = 1024 * 1024
+    report("burst", len(requests), elapsed, latencies, "jobs",
+           f"\n             {unique} unique of {len(requests)}, {api.requests['resolve']} API calls, {app.DOWNLOAD_RATE.total / mib:.0f} MiB down "
+           f"({app.DOWNLOAD_RATE.total / mib / elapsed:.1f} MiB/s), {client.uploaded_bytes / mib:.0f} MiB up, {client.calls['send_file']} sends")
+
+async def scenario_tagall(args):
+    client = FakeClient(rtt=args.rtt, participants=args.members); await install(client)
+    app.TAGALL_RATE = 1e6; app.TAGALL_BURST = 1000; app.SEND_BUCKETS.clear(); app.PARTICIPANTS.chats.clear()
+    chat_id = -1003000000000
+    for label in ("cold", "warm"):
+        app.USER_COOLDOWNS.clear(); before = client.sent; message = FakeEvent(FakeMessage(client, chat_id, int(app.SUDO_USER), "/tagall wake up", out=True))
+        start = time.perf_counter(); await app.dispatch_message(message); elapsed = time.perf_counter() - start
+        sent = client.sent - before
+        report(f"tagall/{label}", args.members, elapsed, [elapsed], "mentions",
+               f"\n             {sent} messages ({args.members / max(1, sent):.0f} mentions each), {client.calls['get_participants']} participant pages fetched")
+    await uninstall()
+
+async def scenario_gpt(args):
+    client = FakeClient(rtt=args.rtt); await install(client)
+    api = FakeCompletionAPI(args.tokens, args.first_token, args.token_interval)
+    app.GPT_API_URL = await api.start(); app.GPT_API_KEY = "bench"
+    app.COMPLETIONS = app.ChatCompletions(args.gpt_concurrency, app.GPT_CACHE_SIZE, app.GPT_CACHE_TTL, 0, app.GPT_CONTEXT_CHARS, app.GPT_CONTEXT_CHATS)
+    rng = random.Random(3); unique = max(1, int(args.prompts * (1 - args.duplicates)))
+    topics = [f"explain topic number {i} in simple words" for i in range(unique)]
+    # First wave fills the cache; the repeats arrive after it, the way a popular question gets asked again later.
+    waves = [topics, [rng.choice(topics) for _ in range(args.prompts - unique)]]
+    latencies = []; user_ids = itertools.count(6000)
+    async def run(prompt: str) -> str:
+        """Sends `/gpt prompt` from a fresh user and returns the text its status message ended up showing."""
+        user_id = next(user_ids); app.AUTH_USERS.add(user_id)
+        event = FakeEvent(FakeMessage(client, -1004000000000 - user_id, user_id, f"/gpt {prompt}"))
+        t = time.perf_counter(); await app.dispatch_message(event); latencies.append(time.perf_counter() - t)
+        return app.STATUS_EDITOR.shown.get((event.chat_id, event.id), "")
+    try:
+        start = time.perf_counter()
+        for wave in waves: await asyncio.gather(*(run(prompt) for prompt in wave))
+        elapsed = time.perf_counter() - start
+        report("gpt", args.prompts, elapsed, latencies, "prompts",
+               f"\n             {api.requests} streamed, {app.COMPLETIONS.hits} cached, peak {api.peak} concurrent streams, "
+               f"{app.STATUS_EDITOR.edits} status edits")
+        await check_gpt(api, run)
+    finally:
+        await uninstall(); await api.stop()
+
+async def check_gpt(api: FakeCompletionAPI, run):
+    """Asserts what a user sees: the streamed answer in full, a repeat served without a request, and errors that are
+    reported rather than cached."""
+    api.tokens = 60; prompt = "check the final text"; header = "**💡 Response:**\n\n"
+    requests = api.requests; shown = await run(prompt)
+    assert shown == header + api.answer(prompt), f"final message differs from the streamed text: {shown!r}"
+    assert await run(prompt) == shown and api.requests == requests + 1, "a repeated prompt was not served from the cache"
+    api.fail_status = 503; shown = await run("check an http error"); api.fail_status = 0
+    assert "API error `503`" in shown, f"HTTP error not reported: {shown!r}"
+    api.cut_after = 10; shown = await run("check a cut stream"); api.cut_after = None
+    assert "ended before the answer was complete" in shown, f"cut stream not reported: {shown!r}"
+    requests = api.requests; shown = await run("check a cut stream")
+    assert shown == header + api.answer("check a cut stream") and api.requests == requests + 1, "a cut answer was cached"
+    print("             checks passed: final text, cache hit, HTTP error, cut stream")
+
+SCENARIOS = {"chatter": scenario_chatter, "burst": scenario_burst, "tagall": scenario_tagall, "gpt": scenario_gpt}
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scenario", nargs="?", default="all", choices=[*SCENARIOS, "all"])
+    parser.add_argument("--rtt", type=float, default=0.0, help="seconds per fake Telegram API call")
+    parser.add_argument("--messages", type=int, default=50_000, help="chatter: messages to replay")
+    parser.add_argument("--chats", type=int, default=20); parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--rules", type=int, default=400, help="chatter: deny-list domains per chat")
+    parser.add_argument("--requests", type=int, default=24, help="burst: concurrent /ytmp4 requests")
+    parser.add_argument("--duplicates", type=float, default=0.25, help="burst: share of requests repeating another URL")
+    parser.add_argument("--size-mb", type=int, default=16); parser.add_argument("--api-latency", type=float, default=0.05)
+    parser.add_argument("--download-mbps", type=float, default=800, help="burst: per-connection download bandwidth")
+    parser.add_argument("--link-mbps", type=float, default=400, help="burst: shared upload link bandwidth")
+    parser.add_argument("--members", type=int, default=20_000, help="tagall: group size")
+    parser.add_argument("--prompts", type=int, default=40, help="gpt: /gpt requests"); parser.add_argument("--gpt-concurrency", type=int, default=3)
+    parser.add_argument("--tokens", type=int, default=200, help="gpt: streamed tokens per answer")
+    parser.add_argument("--first-token", type=float, default=0.3); parser.add_argument("--token-interval", type=float, default=0.01)
+    args = parser.parse_args()
+    print(f"FakeClient RTT {args.rtt * 1000:.0f} ms")
+    for name, scenario in SCENARIOS.items():
+        if args.scenario in (name, "all"): await scenario(args)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,208 @@
+"""
+Shared pieces for the offline benchmarks: imports `app` with dummy credentials, and provides a fake Telegram client,
+fake messages and events, local stand-ins for the download and chat completion APIs, and latency/RSS reporting.
+
+Nothing here talks to Telegram or to API_BASE_URL; every "network" cost is a configurable sleep.
+"""
+import os
+import sys
+import time
+import json
+import asyncio
+import resource
+import itertools
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("API_ID", "1"); os.environ.setdefault("API_HASH", "bench"); os.environ.setdefault("SUDO_USER", "1")
+os.environ.setdefault("SESSION_NAME", os.path.join(tempfile.mkdtemp(), "bench_session"))
+import app  # noqa: E402
+
+from aiohttp import web  # noqa: E402
+from hachoir.core import config as hachoir_config  # noqa: E402
+
+hachoir_config.quiet = True  # The fake media is random bytes; hachoir would warn about every parser it rules out.
+
+MESSAGE_IDS = itertools.count(1)
+
+## --- Reporting ---
+def percentile(samples: list, q: float) -> float:
+    if not samples: return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far (ru_maxrss is in KiB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+def report(name: str, count: int, elapsed: float, latencies: list, unit: str = "ops", extra: str = ""):
+    print(f"  {name:<10} {count / elapsed:>12,.1f} {unit}/s   p50 {percentile(latencies, 0.5) * 1000:>8.2f} ms   "
+          f"p99 {percentile(latencies, 0.99) * 1000:>8.2f} ms   peak RSS {peak_rss_mb():>7.1f} MiB{extra}")
+
+## --- Fake Telegram ---
+class FakeUser:
+    __slots__ = ("id", "first_name", "last_name", "username", "bot", "deleted")
+    def __init__(self, user_id: int, bot: bool = False):
+        self.id = user_id; self.first_name = f"User{user_id}"; self.last_name = None; self.username = None
+        self.bot = bot; self.deleted = False
+
+class FakeDocument:
+    __slots__ = ("id", "access_hash", "file_reference")
+    def __init__(self):
+        self.id = next(MESSAGE_IDS); self.access_hash = self.id * 7919; self.file_reference = b"\x01" + self.id.to_bytes(8, "big")
+
+class FakeMessage:
+    """The subset of telethon's Message the handlers touch; `message` is the raw text, as in Telethon."""
+    def __init__(self, client: "FakeClient", chat_id: int, sender_id: int, text: str = "", out: bool = False,
+                 is_group: bool = True, mentioned: bool = False, entities=None, document=None, reply_to_msg=None):
+        self.client = client; self.id = next(MESSAGE_IDS); self.chat_id = chat_id; self.sender_id = sender_id
+        self.raw_text = self.text = self.message = text; self.out = out; self.is_group = is_group; self.is_private = not is_group
+        self.mentioned = mentioned; self.entities = entities; self.document = document; self.photo = None
+        self.media = document; self.reply_to = None; self.reply_to_msg = reply_to_msg; self.pattern_match = None
+        self.sender = client.users.get(sender_id)
+    @property
+    def is_reply(self) -> bool: return self.reply_to_msg is not None
+    async def get_reply_message(self): return self.reply_to_msg
+    async def get_input_chat(self): return self.chat_id
+    async def get_input_sender(self): return self.sender_id
+    async def edit(self, text: str, **kwargs):
+        await self.client.roundtrip("edit_message"); self.text = self.raw_text = self.message = text
+        return self
+    async def reply(self, text: str, **kwargs): return await self.client.send_message(self.chat_id, text)
+    async def delete(self): await self.client.roundtrip("delete_messages")
+
+class FakeEvent:
+    """A NewMessage event: `event.message` is the message and every other attribute is read through to it."""
+    def __init__(self, message: FakeMessage):
+        self.message = message; self.pattern_match = None
+    def __getattr__(self, name: str): return getattr(self.message, name)
+
+class FakeDeletedEvent:
+    __slots__ = ("chat_id", "deleted_ids")
+    def __init__(self, chat_id: int | None, deleted_ids: list):
+        self.chat_id = chat_id; self.deleted_ids = deleted_ids
+
+class FakeClient:
+    """Stands in for the TelegramClient: each API call sleeps `rtt`, is counted by name, and never leaves the process.
+    Upload parts also pass through a link of `link_bytes_per_sec` shared by all concurrent parts."""
+    def __init__(self, rtt: float = 0.0, link_bytes_per_sec: float = 0.0, participants: int = 0):
+        self.rtt = rtt; self.link = link_bytes_per_sec; self.link_free_at = 0.0
+        self.calls = Counter(); self.sent = 0; self.uploaded_bytes = 0
+        self.users = {uid: FakeUser(uid) for uid in range(1000, 1000 + participants)}
+    async def roundtrip(self, name: str, extra: float = 0.0):
+        self.calls[name] += 1
+        if self.rtt or extra: await asyncio.sleep(self.rtt + extra)
+    async def __call__(self, request, ordered: bool = False, flood_sleep_threshold=None):
+        part = getattr(request, "bytes", None); delay = 0.0
+        if part is not None:
+            self.uploaded_bytes += len(part)
+            if self.link:
+                now = time.perf_counter(); start = max(now, self.link_free_at)
+                self.link_free_at = start + len(part) / self.link; delay = self.link_free_at - now
+        await self.roundtrip(type(request).__name__, delay)
+        return True
+    async def send_message(self, chat_id, text: str = "", file=None, **kwargs) -> FakeMessage:
+        await self.roundtrip("send_message"); self.sent += 1
+        return FakeMessage(self, chat_id, int(app.SUDO_USER), text, out=True)
+    async def send_file(self, chat_id, file, caption: str | None = None, **kwargs) -> FakeMessage:
+        await self.roundtrip("send_file"); self.sent += 1
+        return FakeMessage(self, chat_id, int(app.SUDO_USER), caption or "", out=True, document=FakeDocument())
+    async def get_entity(self, user_id: int):
+        await self.roundtrip("get_entity")
+        return self.users.get(user_id) or FakeUser(user_id)
+    async def iter_participants(self, chat, page: int = 200):
+        for i, user in enumerate(self.users.values()):
+            if i % page == 0: await self.roundtrip("get_participants")
+            yield user
+    def is_connected(self) -> bool: return False
+
+async def install(client: FakeClient):
+    """Points `app` at the fake client and at a throwaway cache directory and state database."""
+    workdir = tempfile.mkdtemp(prefix="bench_"); app.client = client
+    app.CACHE_DIRECTORY = os.path.join(workdir, "downloads"); os.makedirs(app.CACHE_DIRECTORY, exist_ok=True)
+    app.MEDIA_CACHE = app.MediaCache(app.CACHE_DIRECTORY, os.path.join(app.CACHE_DIRECTORY, "cache_index.json"), app.CACHE_MAX_BYTES, app.CACHE_MAX_AGE); app.MEDIA_CACHE.load()
+    app.STATE_STORE = app.StateStore(os.path.join(workdir, "state.db"), app.STATE_FLUSH_DELAY); await app.STATE_STORE.open()
+    app.FILE_REFS.clear(); app.IN_FLIGHT_MEDIA.clear(); app.ACTIVE_DOWNLOADS.clear()
+async def uninstall():
+    await app.close_http_session(); await app.STATE_STORE.close(); app.shutdown_media_pool()
+
+## --- Fake download API ---
+class FakeDownloadAPI:
+    """Local stand-in for API_BASE_URL: `/download/<source>/<kind>?url=` answers with the same JSON shape after
+    `api_latency`, and `/files/<name>?size=` serves deterministic bytes with Range support at `bandwidth` bytes/s per
+    connection after `first_byte` seconds."""
+    CHUNK = 64 * 1024
+    def __init__(self, file_size: int, api_latency: float = 0.05, first_byte: float = 0.02, bandwidth: float = 0.0):
+        self.file_size = file_size; self.api_latency = api_latency; self.first_byte = first_byte; self.bandwidth = bandwidth
+        self.block = os.urandom(1024 * 1024); self.requests = Counter(); self.runner = None; self.base_url = None
+
+    async def resolve(self, request):
+        self.requests["resolve"] += 1; await asyncio.sleep(self.api_latency)
+        source, kind = request.match_info["source"], request.match_info["kind"]
+        name = f"{abs(hash(request.query.get('url', ''))):x}.{'mp3' if kind == 'audio' else 'mp4'}"
+        return web.json_response({"success": True, "result": {"title": f"{source} {name}", "quality": "720p", "thumbnail": None,
+                                                               "download_url": f"{self.base_url}/files/{name}?size={self.file_size}"}})
+    async def serve(self, request):
+        self.requests["file"] += 1; size = int(request.query.get("size", self.file_size)); start, end, status = 0, size - 1, 200
+        if request.http_range.start is not None or request.http_range.stop is not None:
+            start = request.http_range.start or 0; end = min(size, request.http_range.stop or size) - 1; status = 206
+        await asyncio.sleep(self.first_byte)
+        response = web.StreamResponse(status=status, headers={"Content-Length": str(end - start + 1), "Accept-Ranges": "bytes"})
+        if status == 206: response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await response.prepare(request)
+        position = start
+        while position <= end:
+            offset = position % len(self.block); length = min(self.CHUNK, end - position + 1, len(self.block) - offset)
+            await response.write(self.block[offset:offset + length]); position += length
+            if self.bandwidth: await asyncio.sleep(length / self.bandwidth)
+        await response.write_eof()
+        return response
+
+    async def start(self) -> str:
+        api = web.Application()
+        api.router.add_get("/download/{source}/{kind}", self.resolve); api.router.add_get("/files/{name}", self.serve)
+        self.runner = web.AppRunner(api, access_log=None); await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0); await site.start()
+        port = site._server.sockets[0].getsockname()[1]; self.base_url = f"http://127.0.0.1:{port}"
+        return f"{self.base_url}/download"
+    async def stop(self):
+        if self.runner: await self.runner.cleanup()
+
+## --- Fake completion API ---
+class FakeCompletionAPI:
+    """Local OpenAI-style `/v1/chat/completions` that streams `tokens` server-sent events, the first after `first_token`
+    seconds and the rest `token_interval` apart. Counts requests and the peak number of streams open at once.
+    Setting `fail_status` answers with that HTTP error instead; `cut_after` ends the stream after that many tokens, without [DONE]."""
+    def __init__(self, tokens: int = 200, first_token: float = 0.3, token_interval: float = 0.01):
+        self.tokens = tokens; self.first_token = first_token; self.token_interval = token_interval
+        self.fail_status = 0; self.cut_after = None
+        self.requests = 0; self.active = 0; self.peak = 0; self.runner = None
+
+    def answer(self, prompt: str) -> str:
+        """The full text the server streams for `prompt`."""
+        words = prompt.split() or ["ok"]
+        return " ".join(words[i % len(words)] for i in range(self.tokens))
+
+    async def complete(self, request):
+        body = await request.json(); self.requests += 1; self.active += 1; self.peak = max(self.peak, self.active)
+        try:
+            if not body.get("stream"): return web.json_response({"error": {"message": "bench server only streams"}}, status=400)
+            if self.fail_status: return web.json_response({"error": {"message": "injected failure"}}, status=self.fail_status)
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+            await response.prepare(request); await asyncio.sleep(self.first_token)
+            words = body["messages"][-1]["content"].split() or ["ok"]
+            for i in range(self.tokens if self.cut_after is None else min(self.tokens, self.cut_after)):
+                chunk = {"choices": [{"index": 0, "delta": {"content": words[i % len(words)] + " "}}]}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                if self.token_interval: await asyncio.sleep(self.token_interval)
+            if self.cut_after is None: await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        finally: self.active -= 1
+
+    async def start(self) -> str:
+        api = web.Application(); api.router.add_post("/v1/chat/completions", self.complete)
+        self.runner = web.AppRunner(api, access_log=None); await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0); await site.start()
+        return f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/v1/chat/completions"
+    async def stop(self):
+        if self.runner: await self.runner.cleanup()
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "bench")]  # `harness` provides the fake client and APIs the tests reuse
+os.environ.setdefault("API_ID", "1"); os.environ.setdefault("API_HASH", "test"); os.environ.setdefault("SUDO_USER", "1")
+os.environ.setdefault("SESSION_NAME", os.path.join(tempfile.mkdtemp(), "test_session"))
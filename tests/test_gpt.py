@@ -0,0 +1,32 @@
+import asyncio
+
+from harness import app, FakeClient, FakeMessage, FakeEvent, FakeCompletionAPI, install, uninstall
+
+
+def test_astral_plane_answer_is_split_in_utf16_units():
+    async def scenario():
+        client = FakeClient(); await install(client)
+        api = FakeCompletionAPI(tokens=1500, first_token=0, token_interval=0)
+        app.GPT_API_URL = await api.start(); app.GPT_API_KEY = "test"
+        app.COMPLETIONS = app.ChatCompletions(1, app.GPT_CACHE_SIZE, app.GPT_CACHE_TTL, 0, app.GPT_CONTEXT_CHARS, app.GPT_CONTEXT_CHATS)
+        sent = []; send_message = client.send_message
+        async def record(chat_id, text="", **kwargs): sent.append(text); return await send_message(chat_id, text, **kwargs)
+        client.send_message = record
+        try:
+            # Each 😀 is one Python character but two UTF-16 code units, so the answer fits 4096 characters but not 4096 units.
+            prompt = "😀 𝔘𝔫𝔦𝔠𝔬𝔡𝔢"; app.AUTH_USERS.add(7)
+            event = FakeEvent(FakeMessage(client, -7, 7, f"/gpt {prompt}")); await app.dispatch_message(event)
+            messages = [app.STATUS_EDITOR.shown[(event.chat_id, event.id)]] + sent
+            header = "**💡 Response:**\n\n"
+            assert len(messages) > 1 and all(app.utf16_length(text) <= app.MESSAGE_LENGTH_LIMIT for text in messages)
+            assert all(text.startswith(header) for text in messages)
+            assert "".join(text[len(header):] for text in messages) == api.answer(prompt)
+        finally:
+            await uninstall(); await api.stop()
+    asyncio.run(scenario())
+
+def test_pack_lines_splits_a_line_longer_than_one_message():
+    line = "🎉" * 5000
+    messages = list(app.pack_lines([line, "tail"], "**head**", limit=1000))
+    assert all(app.utf16_length(text) <= 1000 for text in messages)
+    assert "".join(text[len("**head**\n\n"):] for text in messages) == line + "\ntail"
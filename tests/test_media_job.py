@@ -0,0 +1,25 @@
+import os
+import asyncio
+
+from harness import app, FakeClient, FakeDownloadAPI, install, uninstall
+
+
+def test_cache_hit_stays_pinned_while_the_api_resolves():
+    async def scenario():
+        client = FakeClient(); await install(client)
+        api = FakeDownloadAPI(1024 * 1024, api_latency=0.2); app.API_BASE_URL = await api.start()
+        try:
+            # A cached file without a title in its sidecar, so the job has to ask the API before uploading it.
+            tmp_path = app.MEDIA_CACHE.temp_path("k.mp4")
+            with open(tmp_path, 'wb') as f: f.write(os.urandom(64 * 1024))
+            path = app.MEDIA_CACHE.commit("k.mp4", tmp_path, "youtube")
+            job = app.MediaJob("k", -1, 5)
+            run = asyncio.ensure_future(app.process_media_job(job, "https://youtu.be/x", "mp4", "youtube", "youtube/videofhd", -1))
+            await asyncio.sleep(0.05)
+            app.MEDIA_CACHE.max_bytes = 0; app.MEDIA_CACHE.evict()  # what another job's commit does on a full cache
+            assert os.path.exists(path)
+            assert await run is True and client.calls["send_file"] == 1
+            assert not app.MEDIA_CACHE.pinned
+        finally:
+            await api.stop(); await uninstall()
+    asyncio.run(scenario())
@@ -0,0 +1,13 @@
+from harness import app, FakeClient, FakeMessage
+
+
+def test_global_cap_evicts_the_oldest_records_across_chats():
+    client = FakeClient(); log = app.MessageLog(per_chat=50, max_bytes=100 * (app.LoggedMessage.RECORD_OVERHEAD + 20))
+    messages = [FakeMessage(client, chat_id, 1, "ten chars!") for _ in range(30) for chat_id in range(10)]
+    for message in messages: log.record(message.chat_id, message)
+    kept = [(chat_id, message_id) for chat_id, buffer in log.chats.items() for message_id in buffer]
+    assert sorted(kept) == sorted((m.chat_id, m.id) for m in messages[-100:])
+    assert log.total_bytes == sum(entry.size for buffer in log.chats.values() for entry in buffer.values()) <= log.max_bytes
+    assert len(log.order) == len(kept)
+    log.clear(3); log.pop(4, [messages[-1].id, messages[-6].id])
+    assert len(log.order) == sum(len(buffer) for buffer in log.chats.values())
@@ -0,0 +1,17 @@
+import logging
+
+from telethon.client.users import _fmt_flood
+from telethon.tl.functions.upload import SaveBigFilePartRequest
+
+import app
+
+
+def test_flood_waits_telethon_sleeps_through_are_counted(capsys):
+    logger = logging.getLogger("telethon.client.users"); level, filters = logger.level, list(logger.filters)
+    request = SaveBigFilePartRequest(file_id=1, file_part=0, file_total_parts=1, bytes=b"")
+    try:
+        app.count_telethon_flood_waits()
+        logger.info(*_fmt_flood(7, request)); logger.info(*_fmt_flood(3, request, early=True))  # exactly what Telethon logs
+        assert app.METRICS.series("flood_waits_total")[(("request", "SaveBigFilePartRequest"), ("source", "telethon"))] == 1
+        assert capsys.readouterr().err == ""  # still not shown, as before the filter was added
+    finally: logger.setLevel(level); logger.filters[:] = filters
@@ -0,0 +1,20 @@
+import asyncio
+
+from harness import app, FakeClient, FakeMessage, FakeEvent, install, uninstall
+
+
+def test_pp_asks_for_photos_with_the_input_sender():
+    async def scenario():
+        client = FakeClient(); await install(client)
+        requested = []
+        async def get_profile_photos(entity): requested.append(entity); return ["photo"]
+        client.get_profile_photos = get_profile_photos
+        app.AUTH_USERS.add(app.SUDO_USER); app.USER_COOLDOWNS.clear(); replied = FakeMessage(client, -5, 1234)
+        input_user = object()
+        async def get_input_sender(): return input_user  # carries the access hash from the update, unlike a bare id
+        replied.get_input_sender = get_input_sender
+        try:
+            await app.dispatch_message(FakeEvent(FakeMessage(client, -5, int(app.SUDO_USER), "/pp", out=True, reply_to_msg=replied)))
+            assert requested == [input_user]
+        finally: await uninstall()
+    asyncio.run(scenario())
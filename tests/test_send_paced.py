@@ -0,0 +1,17 @@
+import asyncio
+
+from harness import app, FakeClient, install, uninstall
+
+
+def test_refilled_send_buckets_are_dropped(monkeypatch):
+    async def scenario():
+        client = FakeClient(); await install(client)
+        monkeypatch.setattr(app, "TAGALL_RATE", 1000); monkeypatch.setattr(app, "TAGALL_BURST", 2); app.SEND_BUCKETS.clear()
+        try:
+            for chat_id in range(30): await app.send_paced(chat_id, "hello")
+            assert len(app.SEND_BUCKETS) == 30
+            await asyncio.sleep(0.01); app.SEND_BUCKETS_PRUNED_AT = 0.0  # as if the prune interval had passed
+            await app.send_paced(0, "again")
+            assert list(app.SEND_BUCKETS) == [0] and client.sent == 31
+        finally: await uninstall()
+    asyncio.run(scenario())
@@ -0,0 +1,49 @@
+import json
+import asyncio
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def old_files(tmp_path, monkeypatch):
+    paths = {name: tmp_path / name for name in ("auth_users.txt", "afk_status.json", "chat_settings.json", "file_refs.json")}
+    monkeypatch.setattr(app, "AUTH_FILE", str(paths["auth_users.txt"])); monkeypatch.setattr(app, "AFK_FILE", str(paths["afk_status.json"]))
+    monkeypatch.setattr(app, "CHAT_SETTINGS_FILE", str(paths["chat_settings.json"])); monkeypatch.setattr(app, "FILE_REFS_FILE", str(paths["file_refs.json"]))
+    return paths
+
+def open_store(path) -> app.StateStore:
+    store = app.StateStore(str(path), 0.01); asyncio.run(store.open())
+    return store
+
+def migrated_marker(store: app.StateStore):
+    return store.conn.execute("SELECT 1 FROM state WHERE scope = 'meta' AND key = 'migrated'").fetchone()
+
+
+def test_corrupt_afk_file_does_not_block_chat_settings(tmp_path, old_files, monkeypatch):
+    old_files["afk_status.json"].write_text('{"is_afk": tr')
+    old_files["chat_settings.json"].write_text(json.dumps({"-100123": {"welcome": "hi"}}))
+    old_files["auth_users.txt"].write_text("42\n")
+    store = open_store(tmp_path / "state.db"); monkeypatch.setattr(app, "STATE_STORE", store)
+    asyncio.run(app.load_persistent_data())
+    assert app.CHAT_SETTINGS == {-100123: {"welcome": "hi"}}
+    assert 42 in app.AUTH_USERS
+    assert migrated_marker(store)
+    assert not old_files["afk_status.json"].exists() and (tmp_path / "afk_status.json.corrupt").exists()
+    assert not old_files["chat_settings.json"].exists() and (tmp_path / "chat_settings.json.migrated").exists()
+    asyncio.run(store.close())
+
+def test_unreadable_file_is_retried_on_next_start(tmp_path, old_files):
+    old_files["chat_settings.json"].mkdir()  # open() fails with an OSError, as for a permission problem
+    old_files["afk_status.json"].write_text(json.dumps({"is_afk": True}))
+    store = open_store(tmp_path / "state.db")
+    assert not migrated_marker(store)
+    assert (tmp_path / "afk_status.json.migrated").exists()
+    asyncio.run(store.close())
+    old_files["chat_settings.json"].rmdir(); old_files["chat_settings.json"].write_text(json.dumps({"7": {"antilink": True}}))
+    store = open_store(tmp_path / "state.db")
+    assert migrated_marker(store)
+    assert asyncio.run(store.load("chat")) == [("7", {"antilink": True})]
+    assert asyncio.run(store.load("afk")) == [("state", {"is_afk": True})]
+    asyncio.run(store.close())
@@ -0,0 +1,17 @@
+import asyncio
+
+from harness import app, FakeClient, FakeMessage, install, uninstall
+
+
+def test_idle_chat_buckets_are_dropped():
+    async def scenario():
+        client = FakeClient(); await install(client)
+        editor = app.StatusEditor(1000, 1000, 2)
+        try:
+            for chat_id in range(50): await editor.edit(FakeMessage(client, chat_id, 1), f"status {chat_id}")
+            assert editor.edits == 50
+            await asyncio.sleep(0.01)  # every bucket refills to its burst
+            await editor.edit(FakeMessage(client, 0, 1), "one more")
+            assert list(editor.chat_buckets) in ([], [0])
+        finally: await uninstall()
+    asyncio.run(scenario())